@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for `Compiler.parse_str` on large generated `.kit` sources.
+
+Run ``python benchmarks/bench_parse.py`` from the top level directory.
+Time per run should grow linearly with the number of references; the
+``legacy`` column re-splits the prefix of the source for every match, as
+`parse_str` did before 0.5, and grows quadratically.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from codekitlang import compiler  # noqa
+
+
+def generate_source(references):
+    lines = ['<!-- $var{} = value {} -->'.format(i, i) for i in range(10)]
+    for i in range(references):
+        lines.append('<p>line {} <!-- $var{} --></p>'.format(i, i % 10))
+    return unicode('\n'.join(lines))
+
+
+def legacy_positions(s):
+    result = []
+    for m in compiler.SPECIAL_COMMENT_RE.finditer(s):
+        for pos in (m.start('wrapper'), m.end('wrapper')):
+            subs = compiler.NEW_LINE_RE.split(s[:pos])
+            result.append((len(subs), len(subs[-1]) + 1))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=3)
+    parser.add_argument('--no-legacy', action='store_true')
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[500, 1000, 2000])
+    options = parser.parse_args()
+    obj = compiler.Compiler()
+    print('{:>10} {:>12} {:>12}'.format('refs', 'parse_str', 'legacy'))
+    for size in options.sizes:
+        s = generate_source(size)
+        current = min(timeit.repeat(lambda: obj.parse_str(s),
+                                    repeat=options.number, number=1))
+        if options.no_legacy:
+            legacy = '-'
+        else:
+            legacy = '{:.4f}s'.format(min(timeit.repeat(
+                lambda: legacy_positions(s), repeat=options.number, number=1
+            )))
+        print('{:>10} {:>11.4f}s {:>12}'.format(size, current, legacy))
+
+
+if __name__ == '__main__':
+    main()
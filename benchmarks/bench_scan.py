@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for finding special comments, `scan_special_comments` against
+`SPECIAL_COMMENT_RE`, on HTML with many ordinary comments.
+
+Run ``python benchmarks/bench_scan.py`` from the top level directory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from codekitlang import compiler  # noqa
+
+
+def generate_comments(size):
+    lines = []
+    for i in range(size):
+        lines.append('<div><!-- ordinary comment {} --><p>text</p>'.format(i))
+        if i % 10 == 0:
+            lines.append('<!-- $var{} = value --><!-- $var{} --></div>'
+                         .format(i, i))
+    return unicode('\n'.join(lines))
+
+
+def generate_unterminated(size):
+    lines = ['<!-- $var{} <p>{}</p>'.format(i % 10, i) for i in range(size)]
+    return unicode('\n'.join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=3)
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[1000, 2000, 4000])
+    options = parser.parse_args()
+    obj = compiler.Compiler()
+    print('{:>16} {:>8} {:>10} {:>10}'.format('source', 'size', 'scan', 're'))
+    for name, generate in (('comments', generate_comments),
+                           ('unterminated', generate_unterminated)):
+        for size in options.sizes:
+            s = generate(size)
+            results = []
+            for func in (compiler.scan_special_comments,
+                         obj.iter_special_comments_re):
+                results.append(min(timeit.repeat(
+                    lambda: list(func(s)), repeat=options.number, number=1
+                )))
+            print('{:>16} {:>8} {:>9.4f}s {:>9.4f}s'.format(
+                name, size, results[0], results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for variable scopes of `Compiler.generate_iter` on deeply nested
+trees storing many variables.
+
+Run ``python benchmarks/bench_scope.py`` from the top level directory.
+The page stores many variables, every file stores a few and includes
+`fanout` files of the next level, which load a variable of the page so they
+are not folded.  The ``legacy`` column copies the whole variable dict for
+every inclusion, as `generate_iter` did before 0.5.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from codekitlang import compiler  # noqa
+
+
+def generate_tree(root, depth, fanout, variables, stores):
+    for level in range(depth + 1):
+        lines = ['<!-- $l{}v{} = value {} -->'.format(level, i, i)
+                 for i in range(stores if level else variables)]
+        lines.append('<p><!-- $l0v0 --></p>')
+        if level < depth:
+            lines.extend(['<!-- @include l{} -->'.format(level + 1)] * fanout)
+        name = 'page.kit' if level == 0 else '_l{}.kit'.format(level)
+        with open(os.path.join(root, name), 'wb') as fp:
+            fp.write('\n'.join(lines))
+    return os.path.join(root, 'page.kit')
+
+
+def legacy_generate_iter(obj, filepath, context=None, stack=()):
+    if context is None:
+        context = dict()
+    if filepath in stack:
+        raise compiler.CyclicInclusionError(filepath, stack)
+    filepath = obj.parse_file(filepath=filepath)
+    for i, command, args in obj.parsed_caches[filepath]['data'] \
+            .iter_commands():
+        if command == 'NOOP':
+            yield args
+        elif command == 'STOR':
+            context[args[0]] = args[1]
+        elif command == 'LOAD':
+            yield context.get(args, '')
+        elif command == 'JUMP' and args:
+            folded = obj.get_folded(args)
+            if folded is not None:
+                yield folded
+                continue
+            for s in legacy_generate_iter(obj, args, context.copy(),
+                                          stack + (filepath,)):
+                yield s
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--variables', type=int, default=200,
+                        help='number of variables stored in the page')
+    parser.add_argument('--stores', type=int, default=2,
+                        help='number of variables stored in each partial')
+    parser.add_argument('--no-legacy', action='store_true')
+    parser.add_argument('depths', nargs='*', type=int, default=[3, 5, 7])
+    options = parser.parse_args()
+    print('{:>10} {:>14} {:>12}'.format('depth', 'generate_iter', 'legacy'))
+    for depth in options.depths:
+        root = tempfile.mkdtemp()
+        try:
+            filepath = os.path.realpath(generate_tree(
+                root, depth, options.fanout, options.variables,
+                options.stores))
+            obj = compiler.Compiler()
+            obj.parse_file(filepath=filepath)
+            current = min(timeit.repeat(
+                lambda: list(obj.generate_iter(filepath)),
+                repeat=options.number, number=1
+            ))
+            if options.no_legacy:
+                legacy = '-'
+            else:
+                legacy = '{:.4f}s'.format(min(timeit.repeat(
+                    lambda: list(legacy_generate_iter(obj, filepath)),
+                    repeat=options.number, number=1
+                )))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        print('{:>10} {:>13.4f}s {:>12}'.format(depth, current, legacy))
+
+
+if __name__ == '__main__':
+    main()
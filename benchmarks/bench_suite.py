@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for hot paths of `Compiler` on a generated synthetic tree.
+
+Run ``python benchmarks/bench_suite.py`` from the top level directory.
+Use ``--json FILE`` to save results, then ``--compare FILE`` on another
+checkout to show ratios against them.
+
+Pages include `fanout` partials of the first level, each partial includes
+`fanout` partials of the next level down to `depth`, and partials are spread
+over `framework-paths` directories (or placed beside pages without them).
+Every benchmark runs in a forked process to report its own peak memory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from codekitlang import compiler  # noqa
+
+logging.basicConfig()
+
+
+def write_file(filepath, lines):
+    d = os.path.dirname(filepath)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    with open(filepath, 'wb') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+
+def generate_body(name, size, variable_density, variables):
+    lines = []
+    length = 0
+    i = 0
+    while length < size:
+        if variables and (i * variable_density) % 1 + variable_density >= 1:
+            lines.append('<p><!-- $var{} --></p>'.format(i % variables))
+        else:
+            lines.append('<p>{} line {} of static text</p>'.format(name, i))
+        length += len(lines[-1]) + 1
+        i += 1
+    return lines
+
+
+def generate_tree(root, options):
+    """
+    @return: base path, framework paths, pages and include names
+    """
+    base = os.path.join(root, 'src')
+    framework_paths = [os.path.join(root, 'fw{}'.format(i))
+                       for i in range(options.framework_paths)]
+    directories = framework_paths or [base]
+    includes = []
+    for level in range(1, options.depth + 1):
+        for k in range(options.fanout):
+            name = 'l{}_{}'.format(level, k)
+            includes.append(name)
+            lines = generate_body(name, options.size,
+                                  options.variable_density, options.variables)
+            if level < options.depth:
+                lines.append('<!-- @include {} -->'.format(', '.join(
+                    'l{}_{}'.format(level + 1, j)
+                    for j in range(options.fanout)
+                )))
+            d = directories[(level * options.fanout + k) % len(directories)]
+            write_file(os.path.join(d, '_{}.kit'.format(name)), lines)
+    pages = []
+    for i in range(options.pages):
+        lines = ['<!-- $var{} = value {} -->'.format(j, j)
+                 for j in range(options.variables)]
+        lines.extend(generate_body('page', options.size,
+                                   options.variable_density,
+                                   options.variables))
+        lines.append('<!-- @include {} -->'.format(', '.join(
+            'l1_{}'.format(j) for j in range(options.fanout)
+        )))
+        filepath = os.path.join(base, 'page{}.kit'.format(i))
+        write_file(filepath, lines)
+        pages.append(filepath)
+    return base, framework_paths, pages, includes
+
+
+def make_compiler(framework_paths, options):
+    return compiler.Compiler(framework_paths=framework_paths,
+                             mmap_threshold=options.mmap_threshold)
+
+
+def bench_parse_str(tree, options):
+    base, framework_paths, pages, includes = tree
+    obj = make_compiler(framework_paths, options)
+    sources = [compiler.get_file_content(filepath)[1] for filepath in pages]
+
+    def run():
+        for s in sources:
+            obj.parse_str(s)
+    return run, sum(len(s) for s in sources), 'chars'
+
+
+def bench_resolve_path(tree, options):
+    base, framework_paths, pages, includes = tree
+
+    def run():
+        obj = make_compiler(framework_paths, options)
+        for _ in range(options.pages):
+            for name in includes:
+                obj.resolve_path(name, base)
+    return run, options.pages * len(includes), 'lookups'
+
+
+def bench_parse_file(tree, options):
+    base, framework_paths, pages, includes = tree
+
+    def run():
+        obj = make_compiler(framework_paths, options)
+        for filepath in pages:
+            obj.parse_file(filepath)
+    size = sum(os.path.getsize(p) for p in pages)
+    return run, size, 'bytes'
+
+
+def bench_parse_file_bounded(tree, options, count=None):
+    """
+    Parse pages with `cache_size` of half of the bytes they take, to evict
+    all along.
+    """
+    base, framework_paths, pages, includes = tree
+    pages = pages[:count]
+    obj = make_compiler(framework_paths, options)
+    for filepath in pages:
+        obj.parse_file(filepath)
+    cache_size = obj.cache_bytes // 2
+
+    def run():
+        obj = make_compiler(framework_paths, options)
+        obj.cache_size = cache_size
+        for filepath in pages:
+            obj.parse_file(filepath)
+    size = sum(os.path.getsize(p) for p in pages)
+    return run, size, 'bytes'
+
+
+def bench_parse_file_bounded_half(tree, options):
+    return bench_parse_file_bounded(tree, options, len(tree[2]) // 2)
+
+
+def bench_generate_to_list(tree, options):
+    base, framework_paths, pages, includes = tree
+    obj = make_compiler(framework_paths, options)
+    size = 0
+    for filepath in pages:
+        size += sum(len(s) for s in obj.generate_to_list(filepath))
+
+    def run():
+        for filepath in pages:
+            obj.generate_to_list(filepath)
+    return run, size, 'chars'
+
+
+def bench_generate_to_file(tree, options):
+    base, framework_paths, pages, includes = tree
+    dest = os.path.join(os.path.dirname(base), 'out')
+    os.mkdir(dest)
+
+    def run():
+        obj = make_compiler(framework_paths, options)
+        for i, filepath in enumerate(pages):
+            obj.generate_to_file(
+                os.path.join(dest, 'page{}.html'.format(i)), filepath)
+    run()
+    size = sum(os.path.getsize(os.path.join(dest, p))
+               for p in os.listdir(dest))
+    return run, size, 'bytes'
+
+
+# ratio of throughputs on half and whole of pages regarded as linear
+SCALING_TOLERANCE = 1.5
+
+BENCHMARKS = (
+    ('parse_str', bench_parse_str),
+    ('resolve_path', bench_resolve_path),
+    ('parse_file', bench_parse_file),
+    ('parse_file_bounded', bench_parse_file_bounded),
+    ('parse_file_bounded_half', bench_parse_file_bounded_half),
+    ('generate_to_list', bench_generate_to_list),
+    ('generate_to_file', bench_generate_to_file),
+)
+
+
+def measure(args):
+    name, tree, options = args
+    func = dict(BENCHMARKS)[name]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run, amount, unit = func(tree, options)
+    seconds = min(timeit.repeat(run, repeat=options.repeat, number=1))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return dict(seconds=seconds, amount=amount, unit=unit, peak_kb=peak)
+
+
+def check_scaling(results, half, whole):
+    """
+    Compare throughputs on half and whole of pages, which are the same if
+    time grows linearly with pages.
+    """
+    if half not in results or whole not in results:
+        return
+    ratio = (results[half]['amount'] / results[half]['seconds']) / \
+        (results[whole]['amount'] / results[whole]['seconds'])
+    print('{} scaling: {:.2f} times slower per {} on twice pages{}'.format(
+        whole, ratio, results[whole]['unit'][:-1],
+        '' if ratio < SCALING_TOLERANCE else ', NOT LINEAR'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='approximate bytes of text in each file')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--variables', type=int, default=10,
+                        help='number of variables stored in each page')
+    parser.add_argument('--variable-density', type=float, default=0.1,
+                        help='ratio of lines loading variables')
+    parser.add_argument('--framework-paths', type=int, default=2)
+    parser.add_argument('--mmap-threshold', type=int, metavar='BYTES',
+                        help='map files of at least BYTES into memory')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', metavar='FILE', help='save results')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='show ratios against saved results')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='names of benchmarks (default: all)')
+    options = parser.parse_args()
+    names = options.benchmarks or [name for name, _ in BENCHMARKS]
+    previous = {}
+    if options.compare:
+        with open(options.compare, 'rb') as fp:
+            previous = json.load(fp)['results']
+
+    root = tempfile.mkdtemp()
+    results = {}
+    try:
+        tree = generate_tree(root, options)
+        print('{:>24} {:>10} {:>16} {:>10} {:>8}'.format(
+            'benchmark', 'time', 'throughput', 'peak', 'ratio'))
+        for name in names:
+            pool = multiprocessing.Pool(1)
+            try:
+                result = pool.apply(measure, ((name, tree, options),))
+            finally:
+                pool.terminate()
+            results[name] = result
+            ratio = '-'
+            if name in previous:
+                ratio = '{:.2f}x'.format(
+                    previous[name]['seconds'] / result['seconds'])
+            print('{:>24} {:>9.4f}s {:>10.0f} {}/s {:>8}KB {:>8}'.format(
+                name, result['seconds'], result['amount'] / result['seconds'],
+                result['unit'][0], result['peak_kb'], ratio))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    check_scaling(results, 'parse_file_bounded_half', 'parse_file_bounded')
+    if options.json:
+        with open(options.json, 'wb') as fp:
+            json.dump(dict(options=vars(options), results=results), fp,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncCompiler(object):
+    """
+    Run `Compiler` in worker threads, not to block the calling thread on
+    file I/O and stat calls.
+
+    Methods return `multiprocessing.pool.AsyncResult`, and call `callback`
+    with the result in a worker thread when given, e.g. to hand it over to
+    an event loop.  Concurrent requests for the same file share one parse
+    in flight instead of each parsing it.
+    """
+
+    def __init__(self, compiler_, threads=None):
+        """
+        @type compiler_: codekitlang.compiler.Compiler
+        @param threads: number of worker threads (default: 4)
+        @type threads: int
+        """
+        self.compiler = compiler_
+        self.pool = ThreadPool(threads or 4)
+        self.flights = dict()
+        self.flights_lock = threading.Lock()
+
+    def single_flight(self, key, func, *args):
+        """
+        Call `func`, or wait for the call in flight with the same key.
+
+        @param key: key of the call
+        @return: return value of `func`
+        """
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+    def _parse_file(self, filepath):
+        filepath = os.path.abspath(filepath)
+        return self.single_flight(('parse', filepath), self._parse, filepath)
+
+    def _parse(self, filepath):
+        return self.compiler.parse_file(filepath=filepath)
+
+    def _generate_to_str(self, filepath):
+        self._parse_file(filepath)
+        return self.compiler.generate_to_str(filepath)
+
+    def _generate_to_file(self, dest, src):
+        self._parse_file(src)
+        return self.compiler.generate_to_file(dest, src)
+
+    def parse_file(self, filepath, callback=None):
+        """
+        @type filepath: str
+        @return: result of `Compiler.parse_file`
+        @rtype: multiprocessing.pool.AsyncResult
+        """
+        return self.pool.apply_async(self._parse_file, (filepath,),
+                                     callback=callback)
+
+    def generate_to_str(self, filepath, callback=None):
+        """
+        @type filepath: str
+        @return: result of `Compiler.generate_to_str`
+        @rtype: multiprocessing.pool.AsyncResult
+        """
+        return self.pool.apply_async(self._generate_to_str, (filepath,),
+                                     callback=callback)
+
+    def generate_to_file(self, dest, src, callback=None):
+        """
+        @type dest: str
+        @type src: str
+        @rtype: multiprocessing.pool.AsyncResult
+        """
+        return self.pool.apply_async(self._generate_to_file, (dest, src),
+                                     callback=callback)
+
+    def close(self):
+        """
+        Wait for requests in progress and stop worker threads.
+        """
+        self.pool.close()
+        self.pool.join()
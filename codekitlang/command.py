@@ -3,22 +3,44 @@
 from __future__ import print_function
 
 import argparse
+import json
 import logging
+import os
+import socket
 import sys
 from . import compiler
+from . import server
+from . import watcher
 
 
 def _(s):
     return s
 
 
+def print_profile(profile, fp):
+    print(_('Counters') + ':', file=fp)
+    for name, value in sorted(profile['counters'].items()):
+        print('  {:<24} {:d}'.format(name, value), file=fp)
+    print(_('Seconds') + ':', file=fp)
+    for name, seconds in sorted(profile['times'].items()):
+        print('  {:<24} {:.6f}'.format(name, seconds), file=fp)
+    for title, key in ((_('Slowest files to parse'), 'parse'),
+                       (_('Slowest include subtrees to parse'), 'subtrees'),
+                       (_('Slowest pages to generate'), 'generate')):
+        print(title + ':', file=fp)
+        for filepath, seconds in profile[key]:
+            print('  {:10.6f} {}'.format(seconds, filepath), file=fp)
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='pykitlangc',
         description=_('CodeKit Language Compiler.'),
     )
-    parser.add_argument('src', nargs=1, metavar='SRC', help=_('input file'))
-    parser.add_argument('dest', nargs=1, metavar='DEST', help=_('output file'))
+    parser.add_argument('src', nargs='?', metavar='SRC',
+                        help=_('input file or directory'))
+    parser.add_argument('dest', nargs='?', metavar='DEST',
+                        help=_('output file or directory'))
     parser.add_argument(
         '-f', '--framework-paths', metavar='DIR', action='append',
         help=_('path for lookup include file (allow multiple defs)'),
@@ -33,20 +55,144 @@ def main():
         choices=('ignore', 'logonly', 'exception'),
         help=_('one of ignore, logonly, exception (default: ignore)'),
     )
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help=_('directory to store parsed files across runs'),
+    )
+    parser.add_argument(
+        '--mmap-threshold', metavar='BYTES', type=int,
+        help=_('map .kit files of at least BYTES into memory instead of '
+               'reading'),
+    )
+    parser.add_argument(
+        '--cache-size', metavar='BYTES', type=int,
+        help=_('keep parsed files within about BYTES of memory, dropping '
+               'least recently used ones; outputs cached from them are not '
+               'counted'),
+    )
+    parser.add_argument(
+        '--stat-window', metavar='SECONDS', type=float,
+        help=_('stat each file once per build, or once in SECONDS if '
+               'longer, for slow file systems'),
+    )
+    parser.add_argument(
+        '--cache-expansions', action='store_true',
+        help=_('render included files once for each set of variables given '
+               'to them, in each process of --jobs'),
+    )
+    parser.add_argument(
+        '--link-outputs', action='store_true',
+        help=_('hard-link identical outputs instead of writing them again, '
+               'within each process of --jobs'),
+    )
+    parser.add_argument(
+        '--manifest', metavar='FILE',
+        help=_('file to record inputs of outputs, for skipping outputs '
+               'not changed'),
+    )
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help=_('number of processes for directory compile (default: 1)'),
+    )
+    parser.add_argument(
+        '-w', '--watch', action='store_true',
+        help=_('keep compiling on changes of files'),
+    )
+    parser.add_argument(
+        '--poll', action='store_true',
+        help=_('watch by polling file status instead of watchdog'),
+    )
+    parser.add_argument(
+        '--serve', metavar='SOCKET',
+        help=_('keep compiling on requests from Unix domain socket, or from '
+               'stdin if SOCKET is "-", without SRC and DEST'),
+    )
+    parser.add_argument(
+        '--connect', metavar='SOCKET',
+        help=_('send SRC and DEST to server serving on Unix domain socket'),
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help=_('print counters and slowest files after compile'),
+    )
+    parser.add_argument(
+        '--profile-top', metavar='N', type=int, default=10,
+        help=_('number of slowest files to print (default: 10)'),
+    )
+    parser.add_argument(
+        '--profile-json', metavar='FILE',
+        help=_('write profile to file as JSON, implies --profile'),
+    )
     namespace = parser.parse_args()
     options = vars(namespace)
     src = options.pop('src')
     dest = options.pop('dest')
+    serve = options.pop('serve')
+    connect = options.pop('connect')
+    if not serve and (src is None or dest is None):
+        parser.error(_('too few arguments'))
+    if connect:
+        try:
+            response = server.request(connect, src, dest)
+        except socket.error as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if response.get('status') != 'ok':
+            print(response.get('message'), file=sys.stderr)
+            sys.exit(1)
+        return
+    jobs = options.pop('jobs')
+    manifest = options.pop('manifest')
+    watch = options.pop('watch')
+    poll = options.pop('poll')
+    profile = options.pop('profile')
+    profile_top = options.pop('profile_top')
+    profile_json = options.pop('profile_json')
+    stats = None
+    if profile or profile_json:
+        stats = options['stats'] = compiler.Stats()
     logger = logging.getLogger('pykitlangc')
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.INFO)
     options['logger'] = logger
     compiler_ = compiler.Compiler(**options)
+    if serve:
+        server_ = server.Server(compiler_, manifest=manifest)
+        try:
+            if serve == '-':
+                server_.serve_stream(sys.stdin, sys.stdout)
+            else:
+                server_.serve_unix(serve)
+        except KeyboardInterrupt:
+            pass
+        return
+    if watch:
+        watcher_ = watcher.Watcher(compiler_, dest, src,
+                                   polling=poll or None)
+        try:
+            watcher_.run()
+        except KeyboardInterrupt:
+            pass
+        return
+    if manifest:
+        compiler_.load_manifest(manifest)
     try:
-        compiler_.generate_to_file(dest[0], src[0])
+        if os.path.isdir(src):
+            compiler_.generate_to_dir(dest, src, jobs=jobs)
+        else:
+            compiler_.generate_to_file(dest, src)
     except compiler.CompileError as e:
         print(e.to_message(), file=sys.stderr)
         sys.exit(1)
+    finally:
+        if manifest:
+            compiler_.dump_manifest(manifest)
+        if stats is not None:
+            profile = compiler_.get_profile(top=profile_top)
+            print_profile(profile, sys.stderr)
+            if profile_json:
+                with open(profile_json, 'wb') as fp:
+                    json.dump(profile, fp, indent=2, sort_keys=True)
 
 if __name__ == '__main__':  # pragma:nocover
     main()
@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import array
+import binascii
+import bisect
+import codecs
 import collections
+import errno
+import hashlib
+import json
 import logging
+import marshal
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 
 def _(s):
@@ -20,6 +35,256 @@ Fragment = collections.namedtuple(
         'args',
     ),
 )
+COMMANDS = ('NOOP', 'STOR', 'LOAD', 'JUMP')
+OPCODES = dict((command, i) for i, command in enumerate(COMMANDS))
+
+
+class FragmentList(object):
+    """
+    Compact sequence of fragments parsed from `source`.
+
+    Fragments are kept as parallel arrays of opcodes and offsets into the
+    source, `Fragment` objects are made on access.  NOOP text is sliced from
+    the source only when iterated, line and column are computed only when
+    accessed.
+
+    When `encoding` is given, source is a byte buffer such as `mmap.mmap`
+    and offsets are in bytes, NOOP text is decoded when sliced.
+    """
+
+    __slots__ = ('source', 'encoding', 'opcodes', 'starts', 'ends', 'args',
+                 '_newlines')
+
+    def __init__(self, source, encoding=None):
+        """
+        @type source: str
+        @param encoding: encoding of `source` if it is a byte buffer
+                         (default: None, `source` is unicode)
+        @type encoding: str
+        """
+        self.source = source
+        self.encoding = encoding
+        self.opcodes = bytearray()
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.args = []  # None for NOOP
+        self._newlines = None
+
+    def append(self, command, start, end, args=None):
+        self.opcodes.append(OPCODES[command])
+        self.starts.append(start)
+        self.ends.append(end)
+        self.args.append(args)
+
+    def set_args(self, i, args):
+        self.args[i] = args
+
+    def indices(self, command):
+        """
+        @return: indices of fragments of the command, without slicing text
+        @rtype: [int, ...]
+        """
+        opcode = OPCODES[command]
+        return [i for i, op in enumerate(self.opcodes) if op == opcode]
+
+    def get_position(self, pos):
+        """
+        @param pos: fpos in source
+        @return: line and column numbers
+        @rtype: (int, int)
+        """
+        if self._newlines is None:
+            # `\r\n` contains exactly one `\n`, same as NEW_LINE_RE
+            newlines = array.array('l')
+            i = self.source.find('\n')
+            while i != -1:
+                newlines.append(i)
+                i = self.source.find('\n', i + 1)
+            self._newlines = newlines
+        n = bisect.bisect_left(self._newlines, pos)
+        line_start = self._newlines[n - 1] + 1 if n else 0
+        if self.encoding:
+            # count characters, not bytes
+            return n + 1, len(self.get_text(line_start, pos)) + 1
+        return n + 1, pos - line_start + 1
+
+    def get_text(self, start, end):
+        """
+        @return: text between offsets of source
+        @rtype: unicode
+        """
+        if self.encoding:
+            return self.source[start:end].decode(self.encoding, 'replace')
+        return self.source[start:end]
+
+    def iter_commands(self):
+        """
+        @return: index, command and args of each fragment, args of NOOP is
+                 sliced text
+        @rtype: iterator of (int, str, object)
+        """
+        if self.encoding:
+            get_text = self.get_text
+            for i, opcode in enumerate(self.opcodes):
+                if opcode:
+                    yield i, COMMANDS[opcode], self.args[i]
+                else:
+                    yield i, 'NOOP', get_text(self.starts[i], self.ends[i])
+            return
+        source = self.source
+        starts = self.starts
+        ends = self.ends
+        args = self.args
+        for i, opcode in enumerate(self.opcodes):
+            if opcode:
+                yield i, COMMANDS[opcode], args[i]
+            else:
+                yield i, 'NOOP', source[starts[i]:ends[i]]
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        opcode = self.opcodes[i]
+        pos = self.starts[i]
+        line, column = self.get_position(pos)
+        if opcode:
+            args = self.args[i]
+        else:
+            args = self.get_text(pos, self.ends[i])
+        return Fragment(pos, line, column, COMMANDS[opcode], args)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FragmentList({!r})'.format(list(self))
+
+    def get_size(self):
+        """
+        @return: approximate bytes held, mapped source is not counted
+        @rtype: int
+        """
+        size = sys.getsizeof(self.opcodes) + sys.getsizeof(self.args)
+        for a in (self.starts, self.ends):
+            size += a.buffer_info()[1] * a.itemsize
+        if not isinstance(self.source, mmap.mmap):
+            size += sys.getsizeof(self.source)
+        return size
+
+    def dumps(self):
+        """
+        @return: marshallable form
+        @rtype: tuple
+        """
+        source = self.source
+        if isinstance(source, mmap.mmap):
+            source = source[:]
+        return (source, self.encoding, str(self.opcodes),
+                self.starts.tostring(), self.ends.tostring(), self.args)
+
+    @classmethod
+    def loads(cls, dumped):
+        """
+        @param dumped: return value of `dumps`
+        @rtype: FragmentList
+        """
+        source, encoding, opcodes, starts, ends, args = dumped
+        obj = cls(source, encoding)
+        obj.opcodes = bytearray(opcodes)
+        obj.starts.fromstring(starts)
+        obj.ends.fromstring(ends)
+        obj.args = list(args)
+        if not len(obj.opcodes) == len(obj.starts) == len(obj.ends) == \
+                len(obj.args):
+            raise ValueError('broken FragmentList')
+        return obj
+
+
+class Scope(object):
+    """
+    Variables visible to a file, a small layer of its own stores over a
+    shared view of variables inherited from including files.
+
+    Children share the view instead of copying variables for every
+    inclusion, stores go to the own layer so they are not seen by including
+    files.  The view is merged only for files storing variables.
+    """
+
+    __slots__ = ('base', 'variables')
+
+    def __init__(self, variables=None, base=None):
+        """
+        @param variables: own layer, updated by stores (default: new dict)
+        @type variables: dict
+        @param base: inherited variables, not updated
+        @type base: dict
+        """
+        self.base = {} if base is None else base
+        self.variables = {} if variables is None else variables
+
+    def merged(self):
+        """
+        @return: view of all variables for children, shared while no
+                 variables are stored, not updated by later stores
+        @rtype: dict
+        """
+        if not self.variables:
+            return self.base
+        merged = self.base.copy()
+        merged.update(self.variables)
+        return merged
+
+    def child(self):
+        """
+        @rtype: Scope
+        """
+        return Scope(base=self.merged())
+
+    def get(self, name, default=None):
+        if name in self.variables:
+            return self.variables[name]
+        return self.base.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.variables or name in self.base
+
+    def __getitem__(self, name):
+        if name in self.variables:
+            return self.variables[name]
+        return self.base[name]
+
+    def __setitem__(self, name, value):
+        self.variables[name] = value
+
+
+RenderPlan = collections.namedtuple(
+    'RenderPlan',
+    (
+        'parts',  # static strings, and empty strings at slots
+        'slots',  # (index of parts, variable name, filepath, fragment)
+        'filepaths',  # files in the inclusion tree
+    ),
+)
 NEW_LINE_RE = re.compile(r'\r?\n', re.MULTILINE)
 SPECIAL_COMMENT_RE = re.compile(
     r'(?P<wrapper><!--\s*(?:'
@@ -29,19 +294,222 @@ SPECIAL_COMMENT_RE = re.compile(
     r')-->)',
     re.DOTALL | re.LOCALE | re.MULTILINE | re.UNICODE
 )
+STORED_CACHE_VERSION = 4
+MANIFEST_VERSION = 2
+# `\s` of SPECIAL_COMMENT_RE, by LOCALE flag
+WHITESPACES = ' \t\n\r\x0b\x0c'
+ASCII_LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+OPENER_RE = re.compile(r'<!--[ \t\n\r\x0b\x0c]*(?=[@$])')
+KEYWORD_RE = re.compile(r'@(?:import|include)(?=[ \t\n\r\x0b\x0c])',
+                        re.IGNORECASE)
+VARIABLE_NAME_RE = re.compile(r'[^ \t\n\r\x0b\x0c:=]*')
+# UTF-32 before UTF-16, BOM_UTF32_LE starts with BOM_UTF16_LE
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+CSS_CHARSET_RE = re.compile(r'@charset "([-\w.:]+)";')
+META_CHARSET_RE = re.compile(
+    r'<meta\s[^>]*?charset\s*=\s*["\']?\s*([-\w.:]+)', re.IGNORECASE)
+# bytes of declarations to look up, as prescan of HTML
+CHARSET_PRESCAN_SIZE = 1024
+# number of locks files are parsed under, shared by files of the same hash
+PARSE_LOCK_STRIPES = 64
+# fraction of `cache_size` to evict down to, to evict in batches
+CACHE_LOW_WATER_MARK = 0.75
+NON_ASCII_RE = re.compile(r'[\x80-\xff]')
 default_logger = logging.getLogger(__name__)
 
 
+def detect_encoding(b):
+    """
+    Detect encoding by BOM, `@charset` rule at the start or `<meta>`
+    declaration in the first `CHARSET_PRESCAN_SIZE` bytes.
+
+    @param b: content or head of it
+    @type b: str
+    @return: encoding name, or None if not detected
+    @rtype: str
+    """
+    for bom, encoding in BOMS:
+        if b.startswith(bom):
+            return encoding
+    m = CSS_CHARSET_RE.match(b, 0, CHARSET_PRESCAN_SIZE) or \
+        META_CHARSET_RE.search(b, 0, CHARSET_PRESCAN_SIZE)
+    if m is None:
+        return None
+    encoding = m.group(1).lower()
+    if encoding.startswith(('utf-16', 'utf-32')):
+        # content declaring itself is readable as ASCII, as HTML does
+        encoding = 'utf-8'
+    return encoding
+
+
+def is_ascii_compatible(encoding):
+    """
+    @type encoding: str
+    @return: False for encodings reading ASCII bytes as other characters,
+             such as 7-bit stateful ISO-2022-JP, UTF-7 and HZ
+    @rtype: bool
+    """
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return True
+    return not (name.startswith(('iso2022', 'utf-16', 'utf-32')) or
+                name in ('utf-7', 'hz'))
+
+
 def get_file_content(filepath, encoding_hints=None):
     """
+    Read file and decode it by detected encoding, or by the first of
+    `encoding_hints` decoding it without errors.
+
+    Content of only ASCII characters without BOM is not decoded, it is
+    returned as str, unless the encoding is not ASCII compatible.
+
     @type filepath: str
+    @param encoding_hints: encodings to try if not detected
+                           (default: utf-8)
     @type encoding_hints: [str, ...]
-    @rtype: (str, str)
+    @return: encoding and content
+    @rtype: (str, unicode)
+    @raise UnknownEncodingError: on unknown declared encoding
     """
     with open(filepath, 'rb') as fp:
         b = fp.read()
-    # TODO: not implemented encoding detection yet
-    return 'utf-8', unicode(b, encoding='utf-8', errors='replace')
+    encoding = detect_encoding(b)
+    if encoding is not None:
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            raise UnknownEncodingError(filepath, encoding)
+        encodings = (encoding,)
+    else:
+        encodings = encoding_hints or ('utf-8',)
+    if not NON_ASCII_RE.search(b) and is_ascii_compatible(encodings[0]):
+        # also no BOM, all of BOMS have a non-ASCII byte
+        return encodings[0], b
+    for encoding in encodings:
+        try:
+            return encoding, b.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return encodings[0], b.decode(encodings[0], 'replace')
+
+
+def scan_special_comments(s):
+    """
+    Find special comments by searching comment openers followed by `@` or
+    `$` and `str.find` on closers, without backtracking of
+    SPECIAL_COMMENT_RE.
+
+    @type s: str
+    @return: start, end, filenames, variable and value of each special
+             comment, as groups of `SPECIAL_COMMENT_RE`
+    @rtype: iterator of (int, int, str, str, str)
+    """
+    # first `-->` at or after closes[0], reused while positions to search
+    # from are not beyond it, to keep scanning linear
+    closes = [0, s.find('-->')]
+
+    def find_close(i):
+        if closes[0] > i or -1 < closes[1] < i:
+            closes[:] = [i, s.find('-->', i)]
+        return closes[1]
+
+    opener = OPENER_RE.search(s)
+    while opener:
+        start, p = opener.span()
+        m = KEYWORD_RE.match(s, p)
+        if m:
+            close = find_close(m.end() + 1)
+            if close == -1:
+                return
+            yield (start, close + 3, s[m.end():close].lstrip(WHITESPACES),
+                   None, None)
+            opener = OPENER_RE.search(s, close + 3)
+            continue
+        if s[p:p + 1] in ('@', '$') and s[p + 1:p + 2] and \
+                s[p + 1:p + 2] in ASCII_LETTERS:
+            close = find_close(p + 2)
+            if close == -1:
+                return
+            e = VARIABLE_NAME_RE.match(s, p + 2, close).end()
+            if e == close:
+                yield start, close + 3, None, s[p + 1:close], None
+            else:  # s[e] is a separator
+                value = s[e:close].lstrip(WHITESPACES)
+                if not value:
+                    value = None
+                elif value[0] in (':', '='):
+                    value = value[1:].lstrip(WHITESPACES)
+                yield start, close + 3, None, s[p + 1:e], value
+            opener = OPENER_RE.search(s, close + 3)
+            continue
+        opener = OPENER_RE.search(s, start + 1)
+
+
+class DigestWriter(object):
+    """
+    File object wrapper computing SHA-1 digest of content while writing.
+    """
+
+    def __init__(self, fp):
+        """
+        @param fp: file object opened in binary mode
+        """
+        self.fp = fp
+        self.hash = hashlib.sha1()
+
+    def write(self, b):
+        self.hash.update(b)
+        self.fp.write(b)
+
+    def writelines(self, chunks):
+        for b in chunks:
+            self.hash.update(b)
+        self.fp.writelines(chunks)
+
+    def hexdigest(self):
+        """
+        @return: SHA-1 hex digest of content written so far
+        @rtype: str
+        """
+        return self.hash.hexdigest()
+
+
+def stat_signature(stat):
+    """
+    @param stat: result of C{os.stat}
+    @return: inode number, mtime and size
+    @rtype: (int, float, int)
+    """
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def files_equal(filepath1, filepath2, chunk_size=65536):
+    """
+    @type filepath1: str
+    @type filepath2: str
+    @return: True if both files exist and have the same content
+    @rtype: bool
+    """
+    try:
+        if os.path.getsize(filepath1) != os.path.getsize(filepath2):
+            return False
+        with open(filepath1, 'rb') as fp1, open(filepath2, 'rb') as fp2:
+            while True:
+                b1 = fp1.read(chunk_size)
+                if b1 != fp2.read(chunk_size):
+                    return False
+                if not b1:
+                    return True
+    except (IOError, OSError):
+        return False
 
 
 class CompileError(Exception):
@@ -77,8 +545,26 @@ class FileNotFoundError(CompileError):
         return s
 
 
+class CompileErrors(CompileError):
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(CompileErrors, self).__init__(errors)
+
+    def to_message(self):
+        return '\n'.join([e.to_message() for e in self.errors])
+
+
 class UnknownEncodingError(CompileError):
-    pass
+
+    def __init__(self, filepath, encoding):
+        self.filepath = filepath
+        self.encoding = encoding
+        super(UnknownEncodingError, self).__init__(filepath, encoding)
+
+    def to_message(self):
+        s = _('Compile Error: unknown encoding "{}" declared on "{}"')
+        return s.format(self.encoding, self.filepath)
 
 
 class VariableNotFoundError(CompileError):
@@ -95,6 +581,54 @@ class VariableNotFoundError(CompileError):
         return s
 
 
+class Stats(object):
+    """
+    Counters and timings collected by `Compiler` while it has `stats`.
+
+    `counters` counts cache hits and misses, stat calls and bytes read,
+    `times` sums seconds spent by kind of work (read, parse, resolve and
+    generate).  `parse_times` keeps seconds to read and parse each file
+    without its included files, `generate_times` keeps seconds to generate
+    each page.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.times = collections.Counter()
+        self.parse_times = dict()
+        self.generate_times = dict()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] += seconds
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def update(self, other):
+        """
+        Add counters and timings collected by other `Stats`, e.g. in worker
+        processes.
+
+        @type other: Stats
+        """
+        self.counters.update(other.counters)
+        self.times.update(other.times)
+        self.parse_times.update(other.parse_times)
+        self.generate_times.update(other.generate_times)
+
+
 class Compiler(object):
 
     NEW_LINE_RE = NEW_LINE_RE
@@ -102,7 +636,11 @@ class Compiler(object):
     logger = default_logger
 
     def __init__(self, framework_paths=None, logger=None,
-                 missing_file_behavior=None, missing_variable_behavior=None):
+                 missing_file_behavior=None, missing_variable_behavior=None,
+                 cache_dir=None, cache_directory_listings=False,
+                 stats=None, mmap_threshold=None, cache_size=None,
+                 stat_window=None, cache_expansions=False,
+                 link_outputs=False):
         """
         @param framework_paths: [str, ...]
         @param logger: logging.Logger
@@ -110,6 +648,40 @@ class Compiler(object):
                                       (default: 'logonly')
         @param missing_variable_behavior: 'ignroe', 'logonly' or 'exception'
                                           (default: 'ignore')
+        @param cache_dir: directory to store parsed files across runs
+                          (default: None, not stored)
+        @param cache_directory_listings: look up include files by listing
+                                         directories once, file names are
+                                         compared case sensitively
+                                         (default: False)
+        @param stats: collect counters and timings into it
+                      (default: None, not collected)
+        @type stats: Stats
+        @param mmap_threshold: map `.kit` files of at least this many bytes
+                               into memory instead of reading, mapped files
+                               are checked before each use and parsed again
+                               if changed (default: None, always read)
+        @type mmap_threshold: int
+        @param cache_size: memory budget of parsed files in bytes, least
+                           recently used files are dropped beyond it and
+                           parsed again when needed; render plans, folded
+                           outputs and expansions are not counted, they
+                           are dropped with files they are built from
+                           (default: None, unbounded)
+        @type cache_size: int
+        @param stat_window: trust results of stat calls until `start_build`
+                            is called, or for this many seconds if longer
+                            (default: None, stat on every check)
+        @type stat_window: float
+        @param cache_expansions: render included files depending on
+                                 variables once for each set of values in a
+                                 build, in each worker process of
+                                 `generate_pages_parallel` (default: False)
+        @param link_outputs: hard-link outputs identical to another output
+                             written in a build instead of writing them
+                             again, outputs of different worker processes
+                             of `generate_pages_parallel` are not linked
+                             (default: False)
         """
         if framework_paths is None:
             self.framework_paths = tuple()
@@ -131,7 +703,62 @@ class Compiler(object):
             missing_variable_behavior = 'ignore'
         self.missing_variable_behavior = missing_variable_behavior
 
+        self.cache_dir = cache_dir
+        self.cache_directory_listings = cache_directory_listings
+        self.stats = stats
+        self.mmap_threshold = mmap_threshold
+        self.cache_size = cache_size
+        self.stat_window = stat_window
+        self.cache_expansions = cache_expansions
+        self.link_outputs = link_outputs
+        # output path -> input path and signatures of included files,
+        # enabled by `load_manifest`
+        self.manifest = None
+
         self.parsed_caches = dict()
+        # variable names shared among parsed files
+        self.interned_names = dict()
+        # reverse index of JUMP targets, filepath -> set of including files
+        self.dependents = dict()
+        # filepath -> RenderPlan
+        self.render_plans = dict()
+        # filepath -> RenderPlan without slots, or None if output of the
+        # file depends on variables given from including file
+        self.folded_caches = dict()
+        # (filename, base_path) -> resolved path and directories looked up
+        self.resolved_paths = dict()
+        # directory -> mtime when looked up first, to detect changes
+        self.directory_mtimes = dict()
+        # directory -> frozenset of names, if `cache_directory_listings`
+        self.directory_listings = dict()
+        # guards `parsed_caches` and `dependents` updates, readers do not
+        # lock, entries are replaced instead of updated
+        self.lock = threading.RLock()
+        # locks held while parsing files, by hash of path, a fixed number
+        # not to grow with files parsed
+        self.parse_locks = tuple(threading.Lock()
+                                 for _ in range(PARSE_LOCK_STRIPES))
+        # incremented when parsed caches are replaced or dropped, derived
+        # caches built meanwhile are not stored
+        self.cache_generation = 0
+        # approximate bytes held by `parsed_caches`
+        self.cache_bytes = 0
+        # filepaths from least recently used, if `cache_size`
+        self.cache_uses = collections.OrderedDict()
+        # path -> signature or None, build generation and time of stat call,
+        # if `stat_window` is not None
+        self.stat_results = dict()
+        # incremented by `start_build`
+        self.build_generation = 0
+        # filepath -> values of variables given to the file -> output, if
+        # `cache_expansions`, cleared by `start_build`
+        self.expansions = dict()
+        # SHA-1 digest -> output path written and its stat signature, if
+        # `link_outputs`, cleared by `start_build`
+        self.output_digests = dict()
+        # output path -> SHA-1 digest recorded for it, cleared by
+        # `start_build`
+        self.output_paths = dict()
 
     def resolve_path(self, filename, base_path):
         """
@@ -139,6 +766,28 @@ class Compiler(object):
         @type base_path: str
         @rtype: str
         """
+        key = (filename, base_path)
+        stats = self.stats
+        if key in self.resolved_paths:
+            if stats is not None:
+                stats.count('resolved_path_hits')
+            return self.resolved_paths[key][0]
+        if stats is None:
+            resolved = self._resolve_path(filename, base_path)
+        else:
+            stats.count('resolved_path_misses')
+            started = time.time()
+            resolved = self._resolve_path(filename, base_path)
+            stats.add_time('resolve', time.time() - started)
+        self.resolved_paths[key] = resolved
+        return resolved[0]
+
+    def _resolve_path(self, filename, base_path):
+        """
+        @return: resolved path or None, and directories looked up
+        @rtype: (str, frozenset)
+        """
+        directories = set()
         _, ext = os.path.splitext(filename)
         if not ext:
             filename += '.kit'
@@ -158,10 +807,122 @@ class Compiler(object):
                         os.path.dirname(filepath),
                         prefix + os.path.basename(filename)
                     )
-                if os.path.exists(filepath):
+                directory, basename = os.path.split(filepath)
+                directories.add(directory)
+                if self.file_exists(directory, basename):
                     self.logger.debug('Using %s for %s', filepath, filename)
-                    return filepath
-        return None
+                    return filepath, frozenset(directories)
+        return None, frozenset(directories)
+
+    def start_build(self):
+        """
+        Start a build, stat results of the last build are no longer trusted
+        unless they are within `stat_window`.  Expansions and outputs of the
+        last build are not shared.
+        """
+        self.build_generation += 1
+        self.expansions = dict()
+        self.output_digests = dict()
+        self.output_paths = dict()
+
+    def stat_file(self, path):
+        """
+        @param path: path of file or directory
+        @type path: str
+        @return: inode number, mtime and size, or None if not exists
+        @rtype: (int, float, int)
+        """
+        window = self.stat_window
+        if window is not None:
+            result = self.stat_results.get(path)
+            if result is not None:
+                signature, generation, checked = result
+                if generation == self.build_generation or \
+                        time.time() - checked < window:
+                    return signature
+        if self.stats is not None:
+            self.stats.count('stat_calls')
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature = None
+        else:
+            signature = stat_signature(stat)
+        if window is not None:
+            self.stat_results[path] = (signature, self.build_generation,
+                                       time.time())
+        return signature
+
+    def get_directory_mtime(self, directory):
+        signature = self.stat_file(directory)
+        return None if signature is None else signature[1]
+
+    def file_exists(self, directory, basename):
+        """
+        Check existence of file, recording mtime of the directory to detect
+        changes by `refresh`.
+
+        @type directory: str
+        @type basename: str
+        @rtype: bool
+        """
+        if directory not in self.directory_mtimes:
+            self.directory_mtimes[directory] = \
+                self.get_directory_mtime(directory)
+        if not self.cache_directory_listings:
+            return self.stat_file(os.path.join(directory, basename)) \
+                is not None
+        listing = self.directory_listings.get(directory)
+        if listing is None:
+            try:
+                listing = frozenset(os.listdir(directory))
+            except OSError:
+                listing = frozenset()
+            self.directory_listings[directory] = listing
+        return basename in listing
+
+    def clear_resolved_paths(self):
+        """
+        Forget resolved include paths and directory listings.
+        """
+        self.resolved_paths.clear()
+        self.directory_mtimes.clear()
+        self.directory_listings.clear()
+
+    def refresh_resolved_paths(self, directories=None):
+        """
+        Resolve include paths again if any directories looked up by them are
+        changed.
+
+        @param directories: directories to check (default: None, all
+                            directories looked up)
+        @type directories: [str, ...]
+        @return: keys of `resolved_paths` resolved to other files
+        @rtype: set
+        """
+        if directories is None:
+            directories = list(self.directory_mtimes)
+        changed_directories = set()
+        for directory in directories:
+            if directory not in self.directory_mtimes:
+                continue
+            mtime = self.directory_mtimes[directory]
+            new_mtime = self.get_directory_mtime(directory)
+            if new_mtime != mtime:
+                changed_directories.add(directory)
+                self.directory_mtimes[directory] = new_mtime
+                self.directory_listings.pop(directory, None)
+        changed = set()
+        if not changed_directories:
+            return changed
+        for key, (filepath, directories) in list(self.resolved_paths.items()):
+            if directories.isdisjoint(changed_directories):
+                continue
+            resolved = self._resolve_path(*key)
+            self.resolved_paths[key] = resolved
+            if resolved[0] != filepath:
+                changed.add(key)
+        return changed
 
     def normalize_path(self, filepath=None, filename=None, basepath=None):
         if filepath:
@@ -172,142 +933,1343 @@ class Compiler(object):
             pass  # TODO: handle assert
         return filepath
 
+    def get_parsed_cache(self, filepath):
+        """
+        Get parsed cache to read fragments from.
+
+        Mapped files are checked before use, reading a mapping of a file
+        truncated in place kills the process by SIGBUS.  The cache of a
+        changed mapped file is dropped, to be parsed again.
+
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @return: parsed cache, or None if not parsed or dropped
+        @rtype: dict
+        """
+        cache = self.parsed_caches.get(filepath)
+        if cache is None:
+            return None
+        source = cache['data'].source
+        if isinstance(source, mmap.mmap) and (
+                source.size() != len(source) or
+                self.stat_file(filepath) != cache['signature']):
+            self.logger.debug('Mapped file %s is changed', filepath)
+            self.invalidate([filepath])
+            return None
+        return cache
+
     def get_new_signature(self, filepath):
         """
         @param filepath: `realpath`ed full path of file
         @type filepath: str
-        @return: tuple of inode number, mtime and size
+        @return: tuple of inode number, mtime and size, or None if not
+                 changed since parsed
         @rtye: (int, int, int) or None
+        @raise OSError: if not exists
         """
         cached_signature = None
-        if filepath in self.parsed_caches:
-            cache = self.parsed_caches[filepath]
+        cache = self.parsed_caches.get(filepath)
+        if cache is not None:
             cached_signature = cache['signature']
-        stat = os.stat(filepath)
-        signature = stat.st_ino, stat.st_mtime, stat.st_size
+        signature = self.stat_file(filepath)
+        if signature is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), filepath)
         if cached_signature and signature == cached_signature:
             signature = None
         return signature
 
-    def parse_str(self, s):
+    def iter_special_comments(self, s):
         """
         @type s: str
-        @rtype: [(int, int, int, str, str), ...]
+        @return: start, end, filenames, variable and value of each special
+                 comment, as groups of `SPECIAL_COMMENT_RE`
+        @rtype: iterator of (int, int, str, str, str)
         """
-        parsed = []
-        pos = 0
-        line = 1
-        column = 1
-        for m in self.SPECIAL_COMMENT_RE.finditer(s):
-            if m.start('wrapper') > pos:
-                subs = s[pos:m.start('wrapper')]
-                parsed.append(Fragment(pos, line, column, 'NOOP', subs))
+        if self.SPECIAL_COMMENT_RE is not SPECIAL_COMMENT_RE:
+            return self.iter_special_comments_re(s)
+        return scan_special_comments(s)
 
-            pos = m.start('wrapper')
-            subs = self.NEW_LINE_RE.split(s[:pos])
-            line = len(subs)
-            column = len(subs[-1]) + 1
+    def iter_special_comments_re(self, s):
+        """
+        Same as `iter_special_comments` but by `SPECIAL_COMMENT_RE`, for
+        subclasses overriding the expression.
+        """
+        for m in self.SPECIAL_COMMENT_RE.finditer(s):
+            yield (m.start('wrapper'), m.end('wrapper'), m.group('filenames'),
+                   m.group('variable'), m.group('value'))
 
-            if m.group('filenames'):
-                for filename in m.group('filenames').split(','):
+    def parse_str(self, s, encoding=None):
+        """
+        @type s: str
+        @param encoding: encoding of `s` if it is a byte buffer such as
+                         `mmap.mmap`, special comments are found in bytes
+                         and only their arguments are decoded here
+                         (default: None, `s` is unicode)
+        @type encoding: str
+        @rtype: FragmentList
+        """
+        parsed = FragmentList(s, encoding)
+        intern_name = self.interned_names.setdefault
+        pos = 0
+        for start, end, filenames, variable, value in \
+                self.iter_special_comments(s):
+            if encoding:
+                filenames, variable, value = [
+                    None if g is None else g.decode(encoding, 'replace')
+                    for g in (filenames, variable, value)
+                ]
+            if start > pos:
+                parsed.append('NOOP', pos, start)
+            if filenames:
+                for filename in filenames.split(','):
                     filename = filename.strip().strip('\'"')
-                    parsed.append(Fragment(pos, line, column, 'JUMP',
-                                           filename))
-            elif m.group('value'):
-                value = m.group('value').strip()
-                parsed.append(Fragment(pos, line, column, 'STOR',
-                                       (m.group('variable'), value)))
-            else:  # m.group('variable')
-                parsed.append(Fragment(pos, line, column, 'LOAD',
-                                       m.group('variable')))
-
-            pos = m.end('wrapper')
-            subs = self.NEW_LINE_RE.split(s[:pos])
-            line = len(subs)
-            column = len(subs[-1]) + 1
-
-        parsed.append(Fragment(pos, line, column, 'NOOP', s[pos:]))
+                    parsed.append('JUMP', start, end, filename)
+            elif value:
+                value = value.strip()
+                variable = intern_name(variable, variable)
+                parsed.append('STOR', start, end, (variable, value))
+            else:  # variable
+                if variable is not None:
+                    variable = intern_name(variable, variable)
+                parsed.append('LOAD', start, end, variable)
+            pos = end
+        parsed.append('NOOP', pos, len(s))
         return parsed
 
+    def read_file(self, filepath, signature):
+        """
+        Read and parse file, or load it from `cache_dir` when signature or
+        content of the file is not changed since stored.
+
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @type signature: (int, int, int)
+        @return: encoding and fragments, JUMP targets are not resolved yet
+        @rtype: (str, FragmentList)
+        """
+        stats = self.stats
+        stored = None
+        if self.cache_dir:
+            stored = self.load_stored_cache(filepath)
+            if stored and stored['signature'] == signature:
+                if stats is not None:
+                    stats.count('stored_cache_hits')
+                return stored['encoding'], stored['data']
+        _, ext = os.path.splitext(filepath)
+        if ext == '.kit' and self.mmap_threshold and \
+                signature[2] >= self.mmap_threshold:
+            mapped = self.map_file(filepath, signature, stored)
+            if mapped is not None:
+                return mapped
+        started = time.time()
+        encoding, s = get_file_content(filepath)
+        if stats is not None:
+            stats.count('bytes_read', signature[2])
+            stats.add_time('read', time.time() - started)
+        digest = None
+        if self.cache_dir:
+            digest = hashlib.sha1(s.encode('utf-8')).hexdigest()
+            if stored and stored['digest'] == digest:
+                if stats is not None:
+                    stats.count('stored_cache_hits')
+                data = stored['data']
+                self.dump_stored_cache(filepath, signature, digest,
+                                       encoding, data)
+                return encoding, data
+            if stats is not None:
+                stats.count('stored_cache_misses')
+        started = time.time()
+        if ext == '.kit':
+            data = self.parse_str(s)
+        else:
+            data = FragmentList(s)
+            data.append('NOOP', 0, len(s))
+        if stats is not None:
+            stats.add_time('parse', time.time() - started)
+        if self.cache_dir:
+            self.dump_stored_cache(filepath, signature, digest, encoding, data)
+        return encoding, data
+
+    def map_file(self, filepath, signature, stored=None):
+        """
+        Parse file mapped into memory, fragments refer to the mapping.
+        Only UTF-8 files without BOM are mapped.
+
+        @param filepath: `realpath`ed full path of `.kit` file
+        @type filepath: str
+        @type signature: (int, int, int)
+        @param stored: return value of `load_stored_cache`
+        @type stored: dict
+        @return: encoding and fragments, JUMP targets are not resolved yet,
+                 or None if the file is in other encoding
+        @rtype: (str, FragmentList)
+        """
+        stats = self.stats
+        encoding = 'utf-8'
+        with open(filepath, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        detected = detect_encoding(buf[:CHARSET_PRESCAN_SIZE])
+        try:
+            if detected and codecs.lookup(detected).name != encoding:
+                buf.close()
+                return None
+        except LookupError:
+            buf.close()
+            return None
+        if stats is not None:
+            stats.count('bytes_mapped', len(buf))
+        digest = None
+        if self.cache_dir:
+            digest = hashlib.sha1(buf).hexdigest()
+            if stored and stored['digest'] == digest:
+                if stats is not None:
+                    stats.count('stored_cache_hits')
+                data = stored['data']
+                self.dump_stored_cache(filepath, signature, digest,
+                                       encoding, data)
+                return encoding, data
+            if stats is not None:
+                stats.count('stored_cache_misses')
+        started = time.time()
+        data = self.parse_str(buf, encoding)
+        if stats is not None:
+            stats.add_time('parse', time.time() - started)
+        if self.cache_dir:
+            self.dump_stored_cache(filepath, signature, digest, encoding, data)
+        return encoding, data
+
+    def get_stored_cache_path(self, filepath):
+        if isinstance(filepath, unicode):
+            filepath = filepath.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(filepath).hexdigest())
+
+    def load_stored_cache(self, filepath):
+        """
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @return: stored signature, digest, encoding and data, or None
+        @rtype: dict
+        """
+        try:
+            with open(self.get_stored_cache_path(filepath), 'rb') as fp:
+                stored = marshal.load(fp)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(stored, tuple) or len(stored) != 6 or \
+                stored[0] != STORED_CACHE_VERSION or stored[1] != filepath:
+            return None
+        _, _, signature, digest, encoding, data = stored
+        try:
+            data = FragmentList.loads(data)
+        except (ValueError, TypeError):
+            return None
+        return dict(
+            signature=signature,
+            digest=digest,
+            encoding=encoding,
+            data=data,
+        )
+
+    def dump_stored_cache(self, filepath, signature, digest, encoding, data):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.get_stored_cache_path(filepath)
+        stored = (STORED_CACHE_VERSION, filepath, tuple(signature), digest,
+                  encoding, data.dumps())
+        # write then rename, to not leave broken files on concurrent runs
+        fd, tmppath = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                marshal.dump(stored, fp)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            self.logger.debug('Cannot store cache for %s', filepath)
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
     def parse_file(self, filepath=None, filename=None, basepath=None):
+        """
+        Parse file and files included by it, by a stack of files to parse
+        instead of recursion.
+
+        @return: `realpath`ed full path of file, or None if not found
+        @rtype: str
+        """
         filepath = self.normalize_path(filepath, filename, basepath)
-        if filepath is None or not os.path.exists(filepath):
-            ex = FileNotFoundError(filepath)
-            if self.missing_file_behavior == 'exception':
-                raise ex
-            if self.missing_file_behavior == 'logonly':
-                self.logger.warn(ex.to_message())
+        if not self.check_file_exists(filepath):
             return None
-        signature = self.get_new_signature(filepath)
-        if signature:
-            _, ext = os.path.splitext(filepath)
-            encoding, s = get_file_content(filepath)
-            if ext == '.kit':
-                data = self.parse_str(s)
-            else:
-                data = [Fragment(0, 1, 1, 'NOOP', s)]
-            self.parsed_caches[filepath] = dict(
-                signature=signature,
-                encoding=encoding,
-                data=data,
-            )
-            for i in range(len(data)):
-                fragment = data[i]
-                if fragment.command == 'JUMP':
-                    subfilepath = self.parse_file(
-                        filename=fragment.args,
-                        basepath=os.path.dirname(filepath)
-                    )
-                    data[i] = Fragment(fragment.pos,
-                                       fragment.line,
-                                       fragment.column,
-                                       'JUMP',
-                                       subfilepath)
+        pending = [filepath]
+        while pending:
+            subfilepaths = self._parse_file(pending.pop())
+            # parse the first included file first, as recursion did
+            pending.extend(reversed(subfilepaths))
+        if self.cache_size is not None and self.cache_bytes > self.cache_size:
+            self.evict(keep=filepath)
         return filepath
 
-    def generate_to_list(self, filepath, context=None, stack=None):
+    def check_file_exists(self, filepath):
+        """
+        @param filepath: `realpath`ed full path of file, or None if not
+                         resolved
+        @return: True if exists, otherwise handled by
+                 `missing_file_behavior`
+        @rtype: bool
+        @raise FileNotFoundError: if not exists and `missing_file_behavior`
+                                  is 'exception'
+        """
+        if filepath is not None and self.stat_file(filepath) is not None:
+            return True
+        ex = FileNotFoundError(filepath)
+        if self.missing_file_behavior == 'exception':
+            raise ex
+        if self.missing_file_behavior == 'logonly':
+            self.logger.warn(ex.to_message())
+        return False
+
+    def touch(self, filepaths):
+        """
+        Record use of parsed files, for eviction by `cache_size`.
+
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        """
+        if self.cache_size is None:
+            return
+        uses = self.cache_uses
+        with self.lock:
+            for filepath in filepaths:
+                # move to the end
+                uses.pop(filepath, None)
+                uses[filepath] = True
+
+    def get_parse_lock(self, filepath):
+        """
+        Get lock to parse file under, shared with files of the same hash.
+        No other parse lock is taken while holding it.
+
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @rtype: threading.Lock
+        """
+        return self.parse_locks[hash(filepath) % len(self.parse_locks)]
+
+    def _parse_file(self, filepath):
+        """
+        Parse existing file if changed, and resolve files included by it.
+
+        Threads parsing the same file wait for the first one, then find the
+        file not changed.  The new entry is published complete.
+
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @return: included files to parse
+        @rtype: [str, ...]
+        """
+        with self.get_parse_lock(filepath):
+            signature = self.get_new_signature(filepath)
+            stats = self.stats
+            if stats is not None:
+                stats.count('parsed_cache_misses' if signature
+                            else 'parsed_cache_hits')
+            if not signature:
+                self.touch([filepath])
+                return []
+            started = time.time()
+            encoding, data = self.read_file(filepath, signature)
+            if stats is not None:
+                stats.parse_times[filepath] = time.time() - started
+            dependencies = set()
+            resolutions = set()
+            subfilepaths = []
+            basepath = os.path.dirname(filepath)
+            for i in data.indices('JUMP'):
+                filename = data.args[i]
+                resolutions.add((filename, basepath))
+                subfilepath = self.normalize_path(filename=filename,
+                                                  basepath=basepath)
+                if not self.check_file_exists(subfilepath):
+                    subfilepath = None
+                data.set_args(i, subfilepath)
+                if subfilepath is not None:
+                    subfilepaths.append(subfilepath)
+                    dependencies.add(subfilepath)
+            size = data.get_size()
+            with self.lock:
+                cache = self.parsed_caches.get(filepath)
+                if cache is not None:
+                    self.cache_generation += 1
+                    self.drop_derived_caches(self.get_ancestors([filepath]))
+                    self.cache_bytes -= cache['size']
+                self._unlink_dependencies(filepath)
+                self.parsed_caches[filepath] = dict(
+                    signature=signature,
+                    encoding=encoding,
+                    data=data,
+                    dependencies=dependencies,
+                    resolutions=resolutions,
+                    size=size,
+                )
+                self.cache_bytes += size
+                self.touch([filepath])
+                for subfilepath in dependencies:
+                    self.dependents.setdefault(
+                        subfilepath, set()).add(filepath)
+        return subfilepaths
+
+    def _unlink_dependencies(self, filepath):
+        cache = self.parsed_caches.get(filepath)
+        if cache is None:
+            return
+        for subfilepath in cache.get('dependencies', ()):
+            dependents = self.dependents.get(subfilepath)
+            if dependents is not None:
+                dependents.discard(filepath)
+                if not dependents:
+                    del self.dependents[subfilepath]
+
+    def get_ancestors(self, filepaths):
+        """
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        @return: given files and all files including them transitively
+        @rtype: set
+        """
+        ancestors = set()
+        pending = list(filepaths)
+        while pending:
+            filepath = pending.pop()
+            if filepath not in ancestors:
+                ancestors.add(filepath)
+                pending.extend(self.dependents.get(filepath, ()))
+        return ancestors
+
+    def invalidate(self, filepaths):
+        """
+        Drop caches of given files.
+
+        Including files keep their caches, they refer children by path and
+        `generate_to_list` re-parses missing children on demand.
+
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        @return: given files and all files including them transitively
+        @rtype: set
+        """
+        with self.lock:
+            self.cache_generation += 1
+            for filepath in filepaths:
+                # changed files may be notified before `stat_window` ends
+                self.stat_results.pop(filepath, None)
+                self.stat_results.pop(os.path.dirname(filepath), None)
+                self._unlink_dependencies(filepath)
+                cache = self.parsed_caches.pop(filepath, None)
+                if cache is not None:
+                    self.cache_bytes -= cache['size']
+                self.cache_uses.pop(filepath, None)
+            ancestors = self.get_ancestors(filepaths)
+            self.drop_derived_caches(ancestors)
+        return ancestors
+
+    def evict(self, keep=None):
+        """
+        Invalidate least recently used files if `cache_bytes` exceeds
+        `cache_size`, until it fits in `CACHE_LOW_WATER_MARK` of it, not to
+        evict again on the next parse.
+
+        Files of folded outputs and expansions count as used with them.
+        Files including evicted files lose their derived caches, as changes
+        of evicted files are no longer detected by `refresh`.
+
+        @param keep: `realpath`ed full path of file not to evict
+        @type keep: str
+        @return: evicted files
+        @rtype: [str, ...]
+        """
+        with self.lock:
+            if self.cache_bytes <= self.cache_size:
+                return []
+            excess = self.cache_bytes - \
+                self.cache_size * CACHE_LOW_WATER_MARK
+            if len(self.cache_uses) < len(self.parsed_caches):
+                # files parsed before `cache_size` was set, as least
+                # recently used
+                uses = collections.OrderedDict(
+                    (filepath, True) for filepath in self.parsed_caches
+                    if filepath not in self.cache_uses)
+                uses.update(self.cache_uses)
+                self.cache_uses = uses
+            evicted = []
+            unparsed = []
+            for filepath in self.cache_uses:
+                if excess <= 0:
+                    break
+                cache = self.parsed_caches.get(filepath)
+                if cache is None:
+                    # touched through derived caches after invalidated
+                    unparsed.append(filepath)
+                elif filepath != keep:
+                    evicted.append(filepath)
+                    excess -= cache['size']
+            for filepath in unparsed:
+                del self.cache_uses[filepath]
+            self.invalidate(evicted)
+        if self.stats is not None:
+            self.stats.count('parsed_cache_evictions', len(evicted))
+        self.logger.debug('Evicted %d parsed files', len(evicted))
+        return evicted
+
+    def drop_derived_caches(self, filepaths):
+        """
+        Drop caches built from parsed caches of given files and their
+        included files.
+
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        """
+        for filepath in filepaths:
+            self.render_plans.pop(filepath, None)
+            self.folded_caches.pop(filepath, None)
+            self.expansions.pop(filepath, None)
+
+    def refresh(self, filepaths=None):
+        """
+        Stat every cached file once and invalidate changed or removed ones,
+        or ones including files resolved to other files.  A new build is
+        started, files are not stat'ed again in it.
+
+        @param filepaths: check only these files and files included by them,
+                          and directories their include paths are looked up
+                          in (default: None, all cached files)
+        @type filepaths: [str, ...]
+        @return: changed files and all files including them transitively
+        @rtype: set
+        """
+        self.start_build()
+        directories = None
+        if filepaths is None:
+            filepaths = list(self.parsed_caches)
+        else:
+            filepaths = self.get_descendants(
+                [os.path.realpath(f) for f in filepaths])
+            directories = set()
+            for filepath in filepaths:
+                cache = self.parsed_caches.get(filepath, {})
+                for key in cache.get('resolutions', ()):
+                    resolved = self.resolved_paths.get(key)
+                    if resolved is not None:
+                        directories.update(resolved[1])
+        changed = []
+        for filepath in filepaths:
+            if filepath not in self.parsed_caches:
+                continue
+            try:
+                signature = self.get_new_signature(filepath)
+            except OSError:
+                signature = True
+            if signature:
+                changed.append(filepath)
+        changed_resolutions = self.refresh_resolved_paths(directories)
+        if changed_resolutions:
+            # including files may be out of `filepaths`
+            for filepath, cache in list(self.parsed_caches.items()):
+                if not changed_resolutions.isdisjoint(
+                        cache.get('resolutions', ())):
+                    changed.append(filepath)
+        return self.invalidate(changed)
+
+    def generate_iter(self, filepath, context=None, stack=None,
+                      inputs=None):
+        """
+        Generate compiled content piece by piece.
+
+        Included files are walked by an explicit stack, not by recursion.
+
+        @type filepath: str
+        @param context: variables, updated by STOR fragments of the file
+        @type context: dict or Scope
+        @param stack: `realpath`ed full paths of including files
+        @type stack: (str, ...)
+        @param inputs: if given, updated with parsed caches of files read,
+                       by their paths, to record them even if evicted while
+                       generating
+        @type inputs: dict
+        @rtype: iterator of unicode
+        """
+        if not isinstance(context, Scope):
+            context = Scope(context)
+        stack = list(stack or ())
+        # files in stack, for cycle detection
+        active = set(stack)
+        # [filepath, data, commands, own variables, inherited variables,
+        #  merged variables for included files] of each file in stack
+        frames = []
+
+        def enter(filepath, scope):
+            if filepath in active:
+                raise CyclicInclusionError(filepath, tuple(stack))
+            cache = self.get_parsed_cache(filepath)
+            while cache is None:
+                # not parsed yet, or invalidated by another thread
+                filepath = self.parse_file(filepath=filepath)
+                if filepath is None:
+                    return
+                cache = self.get_parsed_cache(filepath)
+            self.touch([filepath])
+            if inputs is not None:
+                inputs[filepath] = cache
+            stack.append(filepath)
+            active.add(filepath)
+            data = cache['data']
+            frames.append([filepath, data, data.iter_commands(),
+                           scope.variables, scope.base, None])
+
+        enter(os.path.realpath(filepath), context)
+        while frames:
+            frame = frames[-1]
+            filepath, data, commands, variables, base, merged = frame
+            for i, command, args in commands:
+                if command == 'NOOP':
+                    yield args
+                elif command == 'STOR':
+                    variables[args[0]] = args[1]
+                    merged = None
+                elif command == 'LOAD':
+                    value = variables.get(args)
+                    if value is None:
+                        value = base.get(args)
+                    if value is None:
+                        ex = VariableNotFoundError(filepath, data[i])
+                        if self.missing_variable_behavior == 'exception':
+                            raise ex
+                        elif self.missing_variable_behavior == 'logonly':
+                            self.logger.warn(ex.to_message())
+                        value = ''
+                    yield value
+                elif command == 'JUMP' and args:
+                    folded = self.get_folded(args, inputs)
+                    if folded is not None:
+                        yield folded
+                        continue
+                    if merged is None:
+                        if variables:
+                            merged = base.copy()
+                            merged.update(variables)
+                        else:
+                            merged = base
+                    frame[5] = merged
+                    if self.cache_expansions:
+                        expansion = self.get_expansion(args, merged,
+                                                       inputs)
+                        if expansion is not None:
+                            yield expansion
+                            continue
+                    enter(args, Scope(base=merged))
+                    break
+            else:
+                frames.pop()
+                active.discard(stack.pop())
+
+    def build_render_plan(self, filepath, inputs=None):
+        """
+        Resolve whole inclusion tree of file into a flat list of parts.
+
+        Variables stored in the tree are resolved here, only variables
+        loaded before stored are left as slots for the rendering context.
+
+        @type filepath: str
+        @param inputs: if given, updated with parsed caches of files read,
+                       as `generate_iter` does
+        @type inputs: dict
+        @rtype: RenderPlan
+        @raise CyclicInclusionError: on cyclic inclusion
+        """
+        parts = []
+        slots = []
+        filepaths = set()
+        static = []
+
+        stack = []
+        # files in stack, for cycle detection
+        active = set()
+        # (filepath, data, commands, scope) of each file in stack
+        frames = []
+        # files of stack[:marked] are known not to be foldable
+        marked = 0
+
+        def enter(filepath, scope):
+            if filepath in active:
+                raise CyclicInclusionError(filepath, tuple(stack))
+            cache = self.get_parsed_cache(filepath)
+            while cache is None:
+                # not parsed yet, or invalidated by another thread
+                filepath = self.parse_file(filepath=filepath)
+                if filepath is None:
+                    return
+                cache = self.get_parsed_cache(filepath)
+            self.touch([filepath])
+            if inputs is not None:
+                inputs[filepath] = cache
+            filepaths.add(filepath)
+            stack.append(filepath)
+            active.add(filepath)
+            data = cache['data']
+            frames.append((filepath, data, data.iter_commands(), scope))
+
+        enter(os.path.realpath(filepath), Scope())
+        while frames:
+            filepath, data, commands, scope = frames[-1]
+            for i, command, args in commands:
+                if command == 'NOOP':
+                    static.append(args)
+                elif command == 'STOR':
+                    scope[args[0]] = args[1]
+                elif command == 'LOAD':
+                    value = scope.get(args)
+                    if value is not None:
+                        static.append(value)
+                        continue
+                    if static:
+                        parts.append(''.join(static))
+                        del static[:]
+                    slots.append((len(parts), args, filepath, data[i]))
+                    parts.append('')
+                    # the variable is not found in scopes of files in
+                    # stack either, their outputs depend on it
+                    for f in stack[marked:]:
+                        self.folded_caches[f] = None
+                    marked = len(stack)
+                elif command == 'JUMP' and args:
+                    folded = self.folded_caches.get(args)
+                    if folded is not None:
+                        static.append(folded.parts[0])
+                        filepaths.update(folded.filepaths)
+                        if inputs is not None:
+                            self.add_inputs(inputs, folded.filepaths)
+                    else:
+                        enter(args, scope.child())
+                        break
+            else:
+                frames.pop()
+                active.discard(stack.pop())
+                marked = min(marked, len(stack))
+
+        if static or not parts:
+            parts.append(''.join(static))
+        return RenderPlan(tuple(parts), tuple(slots), frozenset(filepaths))
+
+    def get_render_plan(self, filepath):
+        """
+        @type filepath: str
+        @return: cached or newly built plan
+        @rtype: RenderPlan
+        """
         filepath = os.path.realpath(filepath)
+        plan = self.render_plans.get(filepath)
+        if plan is None:
+            generation = self.cache_generation
+            plan = self.build_render_plan(filepath)
+            with self.lock:
+                if generation == self.cache_generation:
+                    self.render_plans[filepath] = plan
+        return plan
+
+    def get_folded(self, filepath, inputs=None):
+        """
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @param inputs: if given, updated with parsed caches of files in
+                       folded output, as `generate_iter` does
+        @type inputs: dict
+        @return: output of the file if it does not depend on variables
+                 given from including file, otherwise None
+        @rtype: unicode
+        """
+        folded = self.folded_caches.get(filepath, self)
+        if folded is not self:
+            if self.stats is not None:
+                self.stats.count('folded_cache_hits')
+            # keep included files of folded output from eviction
+            if folded is not None:
+                self.touch(folded.filepaths)
+            if folded is not None and inputs is not None:
+                self.add_inputs(inputs, folded.filepaths)
+        else:
+            if self.stats is not None:
+                self.stats.count('folded_cache_misses')
+            generation = self.cache_generation
+            # files read are included in output only if folded
+            read = None if inputs is None else dict()
+            try:
+                plan = self.build_render_plan(filepath, read)
+            except CompileError:
+                # leave it to generation, to raise errors at there
+                return None
+            folded = None if plan.slots else plan
+            with self.lock:
+                if generation == self.cache_generation:
+                    self.folded_caches[filepath] = folded
+            if folded is not None and read:
+                inputs.update(read)
+        return None if folded is None else folded.parts[0]
+
+    def get_expansion(self, filepath, context, inputs=None):
+        """
+        Render included file by its render plan, once for each values of
+        variables loaded from `context` in a build.
+
+        @param filepath: `realpath`ed full path of file
+        @type filepath: str
+        @param context: variables given to the file
+        @type context: dict
+        @param inputs: if given, updated with parsed caches of files in the
+                       plan, as `generate_iter` does
+        @type inputs: dict
+        @return: output of the file, or None if a variable is missing or
+                 the plan is not built
+        @rtype: unicode
+        """
+        plan = self.render_plans.get(filepath)
+        if plan is None:
+            try:
+                plan = self.get_render_plan(filepath)
+            except CompileError:
+                # leave it to generation, to raise errors at there
+                return None
+        values = tuple(context.get(name) for _, name, _, _ in plan.slots)
+        if None in values:
+            # leave it to generation, to handle missing variables
+            return None
+        expansions = self.expansions.get(filepath)
+        if expansions is None:
+            expansions = self.expansions.setdefault(filepath, dict())
+        expansion = expansions.get(values)
+        if expansion is not None:
+            if self.stats is not None:
+                self.stats.count('expansion_hits')
+        else:
+            if self.stats is not None:
+                self.stats.count('expansion_misses')
+            expansion = expansions[values] = self.render(filepath, context)
+        # keep files of the plan from eviction
+        self.touch(plan.filepaths)
+        if inputs is not None:
+            self.add_inputs(inputs, plan.filepaths)
+        return expansion
+
+    def add_inputs(self, inputs, filepaths):
+        """
+        Record parsed caches of files read through derived caches, None for
+        files evicted already.
+
+        @param inputs: parsed caches by paths, as given to `generate_iter`
+        @type inputs: dict
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        """
+        for filepath in filepaths:
+            if inputs.get(filepath) is None:
+                inputs[filepath] = self.parsed_caches.get(filepath)
+
+    def fold_caches(self):
+        """
+        Fold included files which output does not depend on variables given
+        from including files, from the top of inclusion trees.
+
+        Files included only by folded files are not folded, their output is
+        in folded output of including files already, and generation does
+        not enter them.
+        """
+        dependents = self.dependents
+        # number of including files not visited yet, pages are not counted
+        waiting = dict(
+            (filepath, sum(1 for f in parents if f in dependents))
+            for filepath, parents in dependents.items())
+        pending = sorted((f for f, n in waiting.items() if not n),
+                         reverse=True)
+        # folded files and files included only by them
+        covered = set()
+        while pending:
+            filepath = pending.pop()
+            if covered.issuperset(dependents.get(filepath, ())) or \
+                    self.get_folded(filepath) is not None:
+                covered.add(filepath)
+            cache = self.parsed_caches.get(filepath, {})
+            for subfilepath in sorted(cache.get('dependencies', ()),
+                                      reverse=True):
+                if subfilepath in waiting:
+                    waiting[subfilepath] -= 1
+                    if not waiting[subfilepath]:
+                        pending.append(subfilepath)
+
+    def render(self, filepath, context=None):
+        """
+        Generate compiled content using cached render plan, for rendering
+        the same file repeatedly with different contexts.
+
+        @type filepath: str
+        @param context: variables given to the file, not updated
+        @type context: dict
+        @rtype: unicode
+        """
+        plan = self.get_render_plan(filepath)
+        if not plan.slots:
+            return plan.parts[0]
         if context is None:
             context = dict()
-        if stack is None:
-            stack = tuple()
-        if filepath in stack:
-            raise CyclicInclusionError(filepath, stack)
-        compiled = []
-        if filepath not in self.parsed_caches:
-            filepath = self.parse_file(filepath=filepath)
-        cache = self.parsed_caches.get(filepath, {})
-        for fragment in cache.get('data', []):
-            if fragment.command == 'NOOP':
-                compiled.append(fragment.args)
-            elif fragment.command == 'STOR':
-                context[fragment.args[0]] = fragment.args[1]
-            elif fragment.command == 'LOAD':
-                if fragment.args not in context:
-                    ex = VariableNotFoundError(filepath, fragment)
-                    if self.missing_variable_behavior == 'exception':
-                        raise ex
-                    elif self.missing_variable_behavior == 'logonly':
-                        self.logger.warn(ex.to_message())
-                compiled.append(context.get(fragment.args, ''))
-            elif fragment.command == 'JUMP':
-                compiled.extend(
-                    self.generate_to_list(fragment.args, context.copy(),
-                                          stack + (filepath,))
-                )
-        return compiled
+        parts = list(plan.parts)
+        for i, name, slot_filepath, fragment in plan.slots:
+            if name in context:
+                parts[i] = context[name]
+                continue
+            ex = VariableNotFoundError(slot_filepath, fragment)
+            if self.missing_variable_behavior == 'exception':
+                raise ex
+            elif self.missing_variable_behavior == 'logonly':
+                self.logger.warn(ex.to_message())
+        return ''.join(parts)
+
+    def generate_to_list(self, filepath, context=None, stack=None):
+        return list(self.generate_iter(filepath, context, stack))
 
     def generate_to_str(self, filepath):
-        return ''.join(self.generate_to_list(filepath))
+        return ''.join(self.generate_iter(filepath))
+
+    def generate_to_stream(self, fp, filepath, buffer_size=None,
+                           encoding=None, inputs=None):
+        """
+        Write compiled content to file object without holding whole of it.
+
+        Characters not encodable are written as character references.
+
+        @param fp: file object opened in binary mode
+        @type filepath: str
+        @param buffer_size: bytes to gather before calling `fp.writelines`
+                            (default: None, call `fp.write` for each piece)
+        @type buffer_size: int
+        @param encoding: encoding of output (default: None, detected
+                         encoding of the file)
+        @type encoding: str
+        @param inputs: updated with parsed caches of files read, see
+                       `generate_iter`
+        @type inputs: dict
+        """
+        filepath = os.path.realpath(filepath)
+        if encoding is None:
+            if filepath not in self.parsed_caches and \
+                    self.parse_file(filepath=filepath) is None:
+                # already handled by `missing_file_behavior`, nothing to
+                # write
+                return
+            cache = self.parsed_caches.get(filepath)
+            encoding = cache['encoding'] if cache else 'utf-8'
+        encode = codecs.getincrementalencoder(encoding)(
+            'xmlcharrefreplace').encode
+        if not buffer_size:
+            for s in self.generate_iter(filepath, inputs=inputs):
+                fp.write(encode(s))
+            b = encode(u'', True)
+            if b:
+                fp.write(b)
+            return
+        chunks = []
+        size = 0
+        for s in self.generate_iter(filepath, inputs=inputs):
+            b = encode(s)
+            chunks.append(b)
+            size += len(b)
+            if size >= buffer_size:
+                fp.writelines(chunks)
+                chunks = []
+                size = 0
+        b = encode(u'', True)
+        if b:
+            chunks.append(b)
+        fp.writelines(chunks)
 
     def generate_to_file(self, dest, src):
         dest = os.path.realpath(dest)
+        src = os.path.realpath(src)
+        if self.manifest is not None and self.is_up_to_date(dest, src):
+            self.logger.debug('Skipping %s, not changed', dest)
+            if self.stats is not None:
+                self.stats.count('outputs_skipped')
+            return
+        started = time.time()
+        try:
+            self._generate_to_file(dest, src)
+        finally:
+            if self.stats is not None:
+                elapsed = time.time() - started
+                self.stats.generate_times[src] = elapsed
+                self.stats.add_time('generate', elapsed)
+
+    def _generate_to_file(self, dest, src):
         d = os.path.dirname(dest)
         if not os.path.exists(d):
             os.makedirs(d)
-        s = self.generate_to_str(src)
-        # TODO: not implemented encoding detection yet
-        s = s.encode('utf-8')
-        with open(dest, 'wb') as fp:
-            fp.write(s)
-        return
+        # generate into temporary file, to compare with current output
+        tmppath = os.path.join(d, '.{}.{}.tmp'.format(
+            os.path.basename(dest), binascii.hexlify(os.urandom(6))))
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            inputs = None if self.manifest is None else dict()
+            with os.fdopen(fd, 'wb') as fp:
+                writer = DigestWriter(fp) if self.link_outputs else fp
+                self.generate_to_stream(writer, src, inputs=inputs)
+            if inputs is not None:
+                self.manifest[dest] = self.make_manifest_entry(src, inputs)
+            digest = None
+            if self.link_outputs:
+                digest = writer.hexdigest()
+                if self.link_output(dest, tmppath, digest):
+                    return
+            if files_equal(tmppath, dest):
+                if self.stats is not None:
+                    self.stats.count('outputs_unchanged')
+                if digest is not None:
+                    self.record_output(dest, digest)
+                os.remove(tmppath)
+                return
+            if os.path.exists(dest):
+                shutil.copymode(dest, tmppath)
+            os.rename(tmppath, dest)
+            if digest is not None:
+                self.record_output(dest, digest)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def link_output(self, dest, tmppath, digest):
+        """
+        Replace `dest` by a hard link to the output written with the same
+        SHA-1 digest in this build, if any.  Contents are not compared, the
+        output is not linked if its stat signature changed since written.
+
+        @param dest: output path
+        @param tmppath: generated content of `dest`
+        @param digest: SHA-1 digest of generated content
+        @return: True if linked, or linked already
+        @rtype: bool
+        """
+        entry = self.output_digests.get(digest)
+        if entry is None:
+            return False
+        other, signature = entry
+        if other == dest:
+            return False
+        try:
+            changed = stat_signature(os.stat(other)) != signature
+        except OSError:
+            changed = True
+        if changed:
+            self.logger.debug('Output changed since written: %s', other)
+            del self.output_digests[digest]
+            del self.output_paths[other]
+            return False
+        try:
+            linked = os.path.samefile(other, dest)
+        except OSError:
+            linked = False
+        if linked:
+            if self.stats is not None:
+                self.stats.count('outputs_unchanged')
+            return True
+        linkpath = tmppath + '.link'
+        try:
+            os.link(other, linkpath)
+            os.rename(linkpath, dest)
+        except OSError as e:
+            self.logger.debug('Cannot link %s to %s: %s', dest, other, e)
+            if os.path.exists(linkpath):
+                os.remove(linkpath)
+            return False
+        if self.stats is not None:
+            self.stats.count('outputs_linked')
+        self.record_output(dest, digest)
+        return True
+
+    def record_output(self, dest, digest):
+        """
+        Record `dest` as written with `digest`, to link later outputs with
+        the same digest to it.  The digest recorded for the previous content
+        of `dest` in this build is forgotten.
+
+        @param dest: output path
+        @param digest: SHA-1 digest of content of `dest`
+        """
+        previous = self.output_paths.pop(dest, None)
+        if previous is not None:
+            entry = self.output_digests.get(previous)
+            if entry is not None and entry[0] == dest:
+                del self.output_digests[previous]
+        try:
+            signature = stat_signature(os.stat(dest))
+        except OSError:
+            return
+        self.output_paths[dest] = digest
+        self.output_digests.setdefault(digest, (dest, signature))
+
+    def get_descendants(self, filepaths):
+        """
+        @param filepaths: `realpath`ed full paths of files
+        @type filepaths: [str, ...]
+        @return: given files and all files included by them transitively
+        @rtype: set
+        """
+        descendants = set()
+        pending = list(filepaths)
+        while pending:
+            filepath = pending.pop()
+            if filepath not in descendants:
+                descendants.add(filepath)
+                cache = self.parsed_caches.get(filepath, {})
+                pending.extend(cache.get('dependencies', ()))
+        return descendants
+
+    def get_profile(self, top=None):
+        """
+        Summarize `stats` with slowest files.
+
+        @param top: number of slowest entries to list (default: None, all)
+        @type top: int
+        @return: counters, times, and lists of path and seconds of slowest
+                 files to parse, include subtrees to parse and pages to
+                 generate
+        @rtype: dict
+        """
+        stats = self.stats
+
+        def slowest(times):
+            items = sorted(times.items(), key=lambda item: (-item[1], item[0]))
+            return [list(item) for item in items[:top]]
+
+        subtree_times = dict(
+            (filepath, sum(stats.parse_times.get(f, 0.0)
+                           for f in self.get_descendants([filepath])))
+            for filepath in stats.parse_times
+            if self.parsed_caches.get(filepath, {}).get('dependencies')
+        )
+        return dict(
+            counters=dict(stats.counters),
+            times=dict(stats.times),
+            parse=slowest(stats.parse_times),
+            subtrees=slowest(subtree_times),
+            generate=slowest(stats.generate_times),
+        )
+
+    def make_manifest_entry(self, src, caches):
+        """
+        @param src: `realpath`ed input path
+        @param caches: parsed caches of files read for output by their
+                       paths, as recorded by `generate_iter`
+        @type caches: dict
+        @return: signatures of files, None for files not recorded such as
+                 missing `src`, include paths and what they resolved to, and
+                 mtimes of directories looked up for them
+        @rtype: dict
+        """
+        inputs = dict()
+        resolutions = []
+        directories = dict()
+        caches = dict(caches)
+        # not read if missing, but the output depends on it
+        caches.setdefault(src, None)
+        for filepath, cache in sorted(caches.items()):
+            if cache is None:
+                # always rebuilt, its signature is unknown
+                inputs[filepath] = None
+                continue
+            inputs[filepath] = cache['signature']
+            for key in cache['resolutions']:
+                resolved = self.resolved_paths.get(key)
+                if resolved is None:
+                    continue
+                resolutions.append([key[0], key[1], resolved[0]])
+                for directory in resolved[1]:
+                    directories[directory] = self.directory_mtimes.get(
+                        directory)
+        return dict(src=src, inputs=inputs, resolutions=resolutions,
+                    directories=directories)
+
+    def get_manifest_options(self):
+        return dict(
+            version=MANIFEST_VERSION,
+            framework_paths=list(self.framework_paths),
+            missing_file_behavior=self.missing_file_behavior,
+            missing_variable_behavior=self.missing_variable_behavior,
+        )
+
+    def load_manifest(self, path):
+        """
+        Enable skipping of outputs not changed since recorded in manifest
+        file.  Recorded outputs are discarded if options are changed.
+
+        @param path: manifest file, need not exist
+        @type path: str
+        """
+        self.manifest = dict()
+        try:
+            with open(path, 'rb') as fp:
+                stored = json.load(fp)
+        except (IOError, ValueError):
+            return
+        if isinstance(stored, dict) and \
+                stored.get('options') == self.get_manifest_options():
+            self.manifest = stored.get('outputs', {})
+
+    def dump_manifest(self, path):
+        """
+        @type path: str
+        """
+        with open(path, 'wb') as fp:
+            json.dump(dict(options=self.get_manifest_options(),
+                           outputs=self.manifest), fp)
+
+    def is_up_to_date(self, dest, src):
+        """
+        @param dest: `realpath`ed output path
+        @param src: `realpath`ed input path
+        @return: True if no inputs of `dest` are changed since recorded,
+                 and include paths resolve to the same files
+        @rtype: bool
+        """
+        entry = self.manifest.get(dest)
+        if not entry or entry['src'] != src or not os.path.exists(dest):
+            return False
+        for filepath, signature in entry['inputs'].items():
+            if signature is None or \
+                    self.stat_file(filepath) != tuple(signature):
+                return False
+        directories = entry['directories']
+        changed = dict()
+        for directory, mtime in directories.items():
+            new_mtime = self.get_directory_mtime(directory)
+            if new_mtime != mtime:
+                changed[directory] = new_mtime
+        if not changed:
+            return True
+        # files may be created or removed in looked up directories
+        for filename, basepath, filepath in entry['resolutions']:
+            if self.resolve_path(filename, basepath) != filepath:
+                return False
+        directories.update(changed)
+        return True
+
+    def list_pages(self, dest_dir, src_dir):
+        """
+        Find pages to compile, non-underscore `.kit` files under `src_dir`.
+
+        @type dest_dir: str
+        @type src_dir: str
+        @return: pairs of output path mirrored under `dest_dir` and input path
+        @rtype: [(str, str), ...]
+        """
+        src_dir = os.path.realpath(src_dir)
+        dest_dir = os.path.realpath(dest_dir)
+        pages = []
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            dirnames.sort()
+            if dirpath == dest_dir or dirpath.startswith(dest_dir + os.sep):
+                del dirnames[:]
+                continue
+            for filename in sorted(filenames):
+                basename, ext = os.path.splitext(filename)
+                if ext != '.kit' or filename.startswith('_'):
+                    continue
+                src = os.path.join(dirpath, filename)
+                dest = os.path.join(dest_dir,
+                                    os.path.relpath(dirpath, src_dir),
+                                    basename + '.html')
+                pages.append((os.path.normpath(dest), src))
+        return pages
+
+    def generate_to_dir(self, dest_dir, src_dir, jobs=None):
+        """
+        Compile every page under `src_dir` into a mirrored tree under
+        `dest_dir`, sharing caches among pages.
+
+        @type dest_dir: str
+        @type src_dir: str
+        @param jobs: number of worker processes (default: 1)
+        @type jobs: int
+        @return: pairs of output path and input path
+        @rtype: [(str, str), ...]
+        @raise CompileErrors: errors of all failed pages in order of pages,
+                              other pages are compiled
+        """
+        self.start_build()
+        pages = self.list_pages(dest_dir, src_dir)
+        if jobs is not None and jobs > 1:
+            self.generate_pages_parallel(pages, jobs)
+            return pages
+        errors = []
+        for dest, src in pages:
+            self.logger.debug('Compiling %s to %s', src, dest)
+            try:
+                self.generate_to_file(dest, src)
+            except CompileError as e:
+                errors.append(e)
+        if errors:
+            raise CompileErrors(errors)
+        return pages
+
+    def generate_pages_parallel(self, pages, jobs):
+        """
+        Parse all pages in this process, then generate them in forked
+        worker processes sharing parsed caches.
+
+        @param pages: pairs of output path and input path
+        @type pages: [(str, str), ...]
+        @type jobs: int
+        @raise CompileErrors: errors of all failed pages in order of pages
+        """
+        errors = [None] * len(pages)
+        for i, (dest, src) in enumerate(pages):
+            try:
+                self.parse_file(filepath=src)
+            except CompileError as e:
+                # drop partially resolved cache, the page is not generated
+                self.invalidate([os.path.realpath(src)])
+                errors[i] = e
+        self.fold_caches()
+        tasks = [(i, page) for i, page in enumerate(pages) if not errors[i]]
+        pool = multiprocessing.Pool(jobs, _init_worker, (self,))
+        try:
+            for i, e, entry, stats in pool.imap_unordered(_generate_page,
+                                                          tasks):
+                errors[i] = e
+                if stats is not None:
+                    self.stats.update(stats)
+                if entry is not None:
+                    self.manifest[os.path.realpath(pages[i][0])] = entry
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise CompileErrors(errors)
+
+
+_worker_compiler = None
+
+
+def _init_worker(compiler):
+    global _worker_compiler
+    _worker_compiler = compiler
+
+
+def _generate_page(task):
+    i, (dest, src) = task
+    # collect stats of this task only, to be added by the parent process
+    stats = None
+    if _worker_compiler.stats is not None:
+        stats = _worker_compiler.stats = Stats()
+    try:
+        _worker_compiler.generate_to_file(dest, src)
+    except CompileError as e:
+        return i, e, None, stats
+    entry = None
+    if _worker_compiler.manifest is not None:
+        entry = _worker_compiler.manifest.get(os.path.realpath(dest))
+    return i, None, entry, stats
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import SocketServer
+import sys
+import time
+from . import compiler
+
+
+def _(s):
+    return s
+
+
+class Server(object):
+    """
+    Compile on requests keeping a warm `Compiler`.
+
+    Requests and responses are JSON objects, one per line.  A request has
+    ``src`` and ``dest`` paths, a response has ``status`` of ``ok`` or
+    ``error`` with ``message``.  Changed files are detected by
+    `Compiler.refresh` before each request, only the requested page and
+    files included by it are checked for a file request.
+    """
+
+    # seconds to gather changes of manifest before dumping it
+    MANIFEST_INTERVAL = 5.0
+
+    def __init__(self, compiler_, manifest=None):
+        """
+        @type compiler_: codekitlang.compiler.Compiler
+        @param manifest: manifest file, dumped when changed at most once in
+                         `MANIFEST_INTERVAL` and when serving ends
+        @type manifest: str
+        """
+        self.compiler = compiler_
+        self.logger = compiler_.logger
+        self.manifest = manifest
+        self.manifest_changed = False
+        self.manifest_dumped = time.time()
+        if manifest:
+            compiler_.load_manifest(manifest)
+
+    def dump_manifest(self, force=False):
+        """
+        Dump manifest if changed since dumped.
+
+        @param force: dump even if dumped in `MANIFEST_INTERVAL`
+        @type force: bool
+        """
+        if not self.manifest or not self.manifest_changed:
+            return
+        if not force and \
+                time.time() - self.manifest_dumped < self.MANIFEST_INTERVAL:
+            return
+        self.compiler.dump_manifest(self.manifest)
+        self.manifest_changed = False
+        self.manifest_dumped = time.time()
+
+    def get_manifest_entries(self, dest, isdir):
+        """
+        @param dest: output file or directory
+        @type dest: str
+        @param isdir: True if `dest` is a directory
+        @type isdir: bool
+        @return: manifest entries possibly changed by a request, or None if
+                 no manifest is kept
+        @rtype: dict
+        """
+        entries = self.compiler.manifest
+        if entries is None:
+            return None
+        if isdir:
+            return dict(entries)
+        dest = os.path.realpath(dest)
+        return {dest: entries.get(dest)}
+
+    def handle(self, request):
+        """
+        @param request: ``src`` and ``dest`` paths
+        @type request: dict
+        @return: response
+        @rtype: dict
+        """
+        try:
+            src = request['src']
+            dest = request['dest']
+        except (KeyError, TypeError):
+            return dict(status='error', message=_('invalid request'))
+        # same type as paths given on command line, to share cache keys
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        if isinstance(src, unicode):
+            src = src.encode(encoding)
+        if isinstance(dest, unicode):
+            dest = dest.encode(encoding)
+        isdir = os.path.isdir(src)
+        entries = self.get_manifest_entries(dest, isdir)
+        try:
+            if isdir:
+                self.compiler.refresh()
+                self.compiler.generate_to_dir(dest, src)
+            else:
+                self.compiler.refresh([src])
+                self.compiler.generate_to_file(dest, src)
+        except compiler.CompileError as e:
+            return dict(status='error', message=e.to_message())
+        except EnvironmentError as e:
+            return dict(status='error', message=str(e))
+        except Exception as e:
+            # a bug on one request must not stop serving the others
+            self.logger.exception(_('failed to compile %s'), src)
+            return dict(status='error',
+                        message='{}: {}'.format(type(e).__name__, e))
+        finally:
+            if entries is not None and \
+                    entries != self.get_manifest_entries(dest, isdir):
+                self.manifest_changed = True
+                self.dump_manifest()
+        return dict(status='ok')
+
+    def handle_line(self, line):
+        """
+        @param line: request in JSON
+        @type line: str
+        @return: response in JSON, without new line
+        @rtype: str
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = dict(status='error', message=_('invalid request'))
+        else:
+            response = self.handle(request)
+        return json.dumps(response)
+
+    def serve_stream(self, rfile, wfile):
+        """
+        Handle requests until end of `rfile`.
+
+        @param rfile: file object to read requests from
+        @param wfile: file object to write responses to
+        """
+        try:
+            for line in iter(rfile.readline, ''):
+                if not line.strip():
+                    continue
+                wfile.write(self.handle_line(line) + '\n')
+                wfile.flush()
+        finally:
+            self.dump_manifest(force=True)
+
+    def make_unix_server(self, path):
+        """
+        @param path: path of Unix domain socket to bind
+        @type path: str
+        @rtype: SocketServer.UnixStreamServer
+        """
+        server = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+
+            def handle(self):
+                server.serve_stream(self.rfile, self.wfile)
+
+        if os.path.exists(path):
+            os.remove(path)
+        return SocketServer.UnixStreamServer(path, Handler)
+
+    def serve_unix(self, path):  # pragma:nocover
+        unix_server = self.make_unix_server(path)
+        try:
+            unix_server.serve_forever()
+        finally:
+            unix_server.server_close()
+            os.remove(path)
+            self.dump_manifest(force=True)
+
+
+def request(path, src, dest):
+    """
+    Send a request to `Server` listening on Unix domain socket.
+
+    @param path: path of the socket
+    @type path: str
+    @param src: input file or directory
+    @param dest: output file or directory
+    @return: response
+    @rtype: dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        fp = sock.makefile('r+b')
+        try:
+            fp.write(json.dumps(dict(src=os.path.abspath(src),
+                                     dest=os.path.abspath(dest))) + '\n')
+            fp.flush()
+            line = fp.readline()
+        finally:
+            fp.close()
+    finally:
+        sock.close()
+    if not line:
+        return dict(status='error', message=_('no response'))
+    return json.loads(line)
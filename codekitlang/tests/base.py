@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TempTreeTestCase(unittest.TestCase):
+    """
+    Test case writing files under a temporary directory, removed after each
+    test.  Paths given to helpers are relative to the directory.
+    """
+
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def path(self, filename):
+        return os.path.join(self.tempdir, filename)
+
+    def write(self, filename, s):
+        path = self.path(filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(s)
+
+    def read(self, filename):
+        with open(self.path(filename), 'rb') as fp:
+            return fp.read()
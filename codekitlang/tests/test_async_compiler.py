@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import mock
+from .base import TempTreeTestCase
+
+
+class AsyncCompilerTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        from ..async_compiler import AsyncCompiler
+        super(AsyncCompilerTestCase, self).setUp()
+        self.write('_header.kit', 'H')
+        self.write('a.kit', 'A<!--@include header-->')
+        self.obj = AsyncCompiler(
+            Compiler(missing_file_behavior='exception'), threads=4)
+
+    def tearDown(self):
+        self.obj.close()
+        super(AsyncCompilerTestCase, self).tearDown()
+
+    def test_parse_file(self):
+        result = self.obj.parse_file(self.path('a.kit'))
+        self.assertEqual(result.get(1), self.path('a.kit'))
+        self.assertIn(self.path('_header.kit'),
+                      self.obj.compiler.parsed_caches)
+
+    def test_generate_to_str(self):
+        results = []
+        result = self.obj.generate_to_str(self.path('a.kit'),
+                                          callback=results.append)
+        self.assertEqual(result.get(1), 'AH')
+        self.assertEqual(results, ['AH'])
+
+    def test_generate_to_file(self):
+        self.obj.generate_to_file(self.path('a.html'),
+                                  self.path('a.kit')).get(1)
+        with open(self.path('a.html'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'AH')
+
+    def test_error(self):
+        from ..compiler import FileNotFoundError
+        result = self.obj.generate_to_str(self.path('missing.kit'))
+        self.assertRaises(FileNotFoundError, result.get, 1)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        parse_file = self.obj.compiler.parse_file
+
+        def slow_parse_file(**kw):
+            started.set()
+            release.wait(1)
+            return parse_file(**kw)
+
+        with mock.patch.object(self.obj.compiler, 'parse_file',
+                               side_effect=slow_parse_file) as mocked:
+            results = [self.obj.parse_file(self.path('a.kit'))]
+            started.wait(1)
+            results.extend(self.obj.parse_file(self.path('a.kit'))
+                           for _ in range(3))
+            time.sleep(0.1)
+            release.set()
+            self.assertEqual([r.get(1) for r in results],
+                             [self.path('a.kit')] * 4)
+            self.assertEqual(mocked.call_count, 1)
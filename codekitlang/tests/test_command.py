@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import difflib
+import json
 import os
-import shutil
-import tempfile
-import unittest
 import mock
+from .base import TempTreeTestCase
 
+COMPILER = 'codekitlang.compiler.Compiler'
 
-class CommandTestCase(unittest.TestCase):
+
+class CommandTestCase(TempTreeTestCase):
 
     def setUp(self):
+        super(CommandTestCase, self).setUp()
         self.dp = os.path.join(os.path.dirname(__file__), 'data')
         self.basepath = os.path.join(self.dp, 'b')
         self.destpath = os.path.join(self.dp, 'd')
@@ -18,11 +20,6 @@ class CommandTestCase(unittest.TestCase):
             os.path.join(self.dp, 'f1'),
             os.path.join(self.dp, 'f2'),
         )
-        self.tempdir = tempfile.mkdtemp()
-
-    def tearDown(self):
-        if hasattr(self, 'tempdir') and os.path.exists(self.tempdir):
-            shutil.rmtree(self.tempdir, ignore_errors=True)
 
     def test_no_argv(self):
         with mock.patch('sys.argv', new=['PROG']):
@@ -62,3 +59,134 @@ class CommandTestCase(unittest.TestCase):
             from .. import command
             self.assertRaises(SystemExit, command.main)
             mocked_generate_to_file.assert_called_with('DEST', 'SRC')
+
+    def test_directory(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        destdir = os.path.join(self.tempdir, 'dest')
+        os.makedirs(srcdir)
+        with open(os.path.join(srcdir, 'index.kit'), 'wb') as fp:
+            fp.write('<!--$a=A--><!--$a-->')
+        with mock.patch('sys.argv', new=['PROG', srcdir, destdir]):
+            from .. import command
+            command.main()
+        with open(os.path.join(destdir, 'index.html'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'A')
+
+    @mock.patch('codekitlang.compiler.Compiler.generate_to_dir')
+    def test_directory_jobs(self, mocked_generate_to_dir):
+        with mock.patch('sys.argv',
+                        new=['PROG', '-j', '4', self.tempdir, 'DEST']):
+            from .. import command
+            command.main()
+            mocked_generate_to_dir.assert_called_with('DEST', self.tempdir,
+                                                      jobs=4)
+
+    @mock.patch('codekitlang.watcher.Watcher.run')
+    def test_watch(self, mocked_run):
+        mocked_run.side_effect = KeyboardInterrupt()
+        with mock.patch('sys.argv',
+                        new=['PROG', '--watch', '--poll', 'SRC', 'DEST']):
+            from .. import command
+            command.main()
+            mocked_run.assert_called_with()
+
+    def test_compiler_options(self):
+        from .. import command
+        for argv, name, value in (
+                (['--cache-dir', 'CACHE'], 'cache_dir', 'CACHE'),
+                (['--mmap-threshold', '4096'], 'mmap_threshold', 4096),
+                (['--cache-size', '1024'], 'cache_size', 1024),
+                (['--stat-window', '0.5'], 'stat_window', 0.5),
+                (['--cache-expansions'], 'cache_expansions', True),
+                (['--link-outputs'], 'link_outputs', True),
+                ([], 'cache_dir', None),
+                ([], 'cache_expansions', False),
+                ([], 'link_outputs', False)):
+            argv = ['PROG'] + argv + ['SRC', 'DEST']
+            with mock.patch('sys.argv', new=argv), \
+                    mock.patch(COMPILER + '.__init__') as init, \
+                    mock.patch(COMPILER + '.generate_to_file'):
+                init.return_value = None
+                command.main()
+            self.assertEqual(init.call_args[1][name], value, argv)
+
+    def test_build_options(self):
+        self.write('src/_body.kit', '<!--$lang-->|<!--@include nav-->')
+        self.write('src/_nav.kit', 'N')
+        for name, lang in (('a', 'en'), ('b', 'en'), ('c', 'fr')):
+            self.write('src/{}.kit'.format(name),
+                       '<!--$lang={}--><!--@include body-->'.format(lang))
+        argv = ['PROG', '--cache-dir', self.path('cache'),
+                '--cache-size', '1', '--stat-window', '0',
+                '--cache-expansions', '--link-outputs',
+                self.path('src'), self.path('dest')]
+        for _ in range(2):
+            with mock.patch('sys.argv', new=argv):
+                from .. import command
+                command.main()
+            self.assertEqual([self.read('dest/{}.html'.format(name))
+                              for name in 'abc'],
+                             ['en|N', 'en|N', 'fr|N'])
+            self.assertEqual(os.stat(self.path('dest/a.html')).st_ino,
+                             os.stat(self.path('dest/b.html')).st_ino)
+            self.assertTrue(os.listdir(self.path('cache')))
+
+    def test_manifest(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        manifest = os.path.join(self.tempdir, 'manifest.json')
+        os.makedirs(srcdir)
+        with open(os.path.join(srcdir, 'index.kit'), 'wb') as fp:
+            fp.write('A')
+        argv = ['PROG', '--manifest', manifest, srcdir,
+                os.path.join(self.tempdir, 'dest')]
+        with mock.patch('sys.argv', new=argv):
+            from .. import command
+            command.main()
+        self.assertTrue(os.path.exists(manifest))
+
+    def test_profile(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        profile = os.path.join(self.tempdir, 'profile.json')
+        os.makedirs(srcdir)
+        with open(os.path.join(srcdir, 'index.kit'), 'wb') as fp:
+            fp.write('A')
+        argv = ['PROG', '--profile-json', profile, srcdir,
+                os.path.join(self.tempdir, 'dest')]
+        with mock.patch('sys.argv', new=argv):
+            with mock.patch('sys.stderr') as stderr:
+                from .. import command
+                command.main()
+                self.assertTrue(stderr.write.called)
+        with open(profile, 'rb') as fp:
+            stored = json.load(fp)
+        self.assertEqual(stored['generate'][0][0],
+                         os.path.join(os.path.realpath(srcdir), 'index.kit'))
+
+    @mock.patch('codekitlang.server.Server.serve_stream')
+    def test_serve(self, mocked_serve_stream):
+        with mock.patch('sys.argv', new=['PROG', '--serve', '-']):
+            from .. import command
+            command.main()
+            self.assertTrue(mocked_serve_stream.called)
+
+    @mock.patch('codekitlang.server.request')
+    def test_connect(self, mocked_request):
+        mocked_request.return_value = dict(status='error', message='E')
+        argv = ['PROG', '--connect', 'SOCKET', 'SRC', 'DEST']
+        with mock.patch('sys.argv', new=argv):
+            from .. import command
+            self.assertRaises(SystemExit, command.main)
+            mocked_request.assert_called_with('SOCKET', 'SRC', 'DEST')
+        mocked_request.return_value = dict(status='ok')
+        with mock.patch('sys.argv', new=argv):
+            command.main()
+
+    def test_connect_refused(self):
+        argv = ['PROG', '--connect', self.path('socket'), 'SRC', 'DEST']
+        with mock.patch('sys.argv', new=argv), \
+                mock.patch('sys.stderr') as mocked_stderr:
+            from .. import command
+            with self.assertRaises(SystemExit) as cm:
+                command.main()
+        self.assertEqual(cm.exception.code, 1)
+        self.assertTrue(mocked_stderr.write.called)
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import difflib
+import json
 import os
 import shutil
 import tempfile
 import unittest
 import mock
+from .base import TempTreeTestCase
 import testfixtures
 
 
@@ -16,6 +18,24 @@ class ExceptionStringTestCase(unittest.TestCase):
         ex = CompileError()
         ex.to_message()
 
+    def test_compile_errors(self):
+        from ..compiler import CompileErrors
+        from ..compiler import FileNotFoundError
+        ex = CompileErrors([FileNotFoundError('A'), FileNotFoundError('B')])
+        self.assertEqual(
+            ex.to_message(),
+            'Compile Error: file "A" does not found\n'
+            'Compile Error: file "B" does not found'
+        )
+
+    def test_unknown_encoding_error(self):
+        from ..compiler import UnknownEncodingError
+        ex = UnknownEncodingError('A', 'x-unknown')
+        self.assertEqual(
+            ex.to_message(),
+            'Compile Error: unknown encoding "x-unknown" declared on "A"'
+        )
+
     def test_cyclic_inclusion_error(self):
         from ..compiler import CyclicInclusionError
         ex = CyclicInclusionError('A', ('B', 'C', 'D'))
@@ -122,6 +142,68 @@ class ResolveFilePathTestCase(unittest.TestCase):
         self.assertFound('_file15.kit', ('f2', '_file15.kit'))
 
 
+class ResolvedPathsTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        super(ResolvedPathsTestCase, self).setUp()
+        os.makedirs(self.path('src'))
+        os.makedirs(self.path('fw'))
+        self.obj = Compiler(framework_paths=(self.path('fw'),))
+        self.write('src/a.kit', 'A<!--@include b-->')
+        self.write('fw/b.kit', 'FW')
+
+    def test_cached(self):
+        self.assertEqual(self.obj.resolve_path('b', self.path('src')),
+                         self.path('fw/b.kit'))
+        self.assertIsNone(self.obj.resolve_path('c', self.path('src')))
+        with mock.patch('os.path.exists') as mocked:
+            self.assertEqual(self.obj.resolve_path('b', self.path('src')),
+                             self.path('fw/b.kit'))
+            self.assertIsNone(self.obj.resolve_path('c', self.path('src')))
+            self.assertFalse(mocked.called)
+        self.assertEqual(self.obj.resolved_paths[('b', self.path('src'))][1],
+                         frozenset([self.path('src'), self.path('fw')]))
+
+    def test_clear(self):
+        self.assertIsNone(self.obj.resolve_path('c', self.path('src')))
+        self.write('src/c.kit', 'C')
+        self.assertIsNone(self.obj.resolve_path('c', self.path('src')))
+        self.obj.clear_resolved_paths()
+        self.assertEqual(self.obj.resolve_path('c', self.path('src')),
+                         self.path('src/c.kit'))
+
+    def test_refresh_shadowed(self):
+        self.assertEqual(self.obj.generate_to_str(self.path('src/a.kit')),
+                         'AFW')
+        self.assertEqual(self.obj.refresh(), set())
+        self.write('src/b.kit', 'SRC')
+        self.assertEqual(self.obj.refresh(), set([self.path('src/a.kit')]))
+        self.assertEqual(self.obj.generate_to_str(self.path('src/a.kit')),
+                         'ASRC')
+
+    def test_refresh_unrelated(self):
+        self.obj.generate_to_str(self.path('src/a.kit'))
+        self.write('src/unrelated.kit', '')
+        self.assertEqual(self.obj.refresh_resolved_paths(), set())
+        self.assertEqual(self.obj.refresh(), set())
+
+    def test_directory_listings(self):
+        self.obj.cache_directory_listings = True
+        self.assertEqual(self.obj.generate_to_str(self.path('src/a.kit')),
+                         'AFW')
+        self.assertEqual(sorted(self.obj.directory_listings), [
+            self.path('fw'), self.path('src'),
+        ])
+        with mock.patch('os.listdir', return_value=[]) as mocked:
+            self.assertIsNone(self.obj.resolve_path('z', self.path('fw/x')))
+            self.assertEqual(mocked.call_count, 1)
+        self.write('src/b.kit', 'SRC')
+        self.obj.refresh()
+        self.assertEqual(self.obj.generate_to_str(self.path('src/a.kit')),
+                         'ASRC')
+
+
 class NormalizePathTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -293,6 +375,150 @@ value
             Fragment(43, 6, 4, 'NOOP', ' post'),
         ], ret)
 
+    def test_position_crlf(self):
+        from ..compiler import Fragment
+        ret = self.func('a\r\nbb\r\n  <!--$v1-->\r\n<!--$v2-->\rc')
+        self.assertEqual([
+            Fragment(0, 1, 1, 'NOOP', 'a\r\nbb\r\n  '),
+            Fragment(9, 3, 3, 'LOAD', 'v1'),
+            Fragment(19, 3, 13, 'NOOP', '\r\n'),
+            Fragment(21, 4, 1, 'LOAD', 'v2'),
+            Fragment(31, 4, 11, 'NOOP', '\rc'),
+        ], ret)
+
+    def test_position_many(self):
+        lines = ['<!--$v{}-->'.format(i) for i in range(100)]
+        ret = self.func('\n'.join(lines))
+        loads = [f for f in ret if f.command == 'LOAD']
+        self.assertEqual(len(loads), 100)
+        for i, fragment in enumerate(loads):
+            self.assertEqual((fragment.line, fragment.column), (i + 1, 1))
+
+
+class ScanSpecialCommentsTestCase(unittest.TestCase):
+
+    tokens = (
+        u'<!--', u'-->', u'--', u'-', u'>', u'<', u'!', u'@', u'$',
+        u'include', u'IMPORT', u'Include', u'a', u'B', u'1', u':', u'=',
+        u',', u'"', u"'", u' ', u'\n', u'\t', u'\x0b', u'\xa0', u'\u0130mport',
+        u'\u212a',
+    )
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.obj = Compiler()
+
+    def assertSameAsRe(self, s):
+        from ..compiler import scan_special_comments
+        self.assertEqual(list(scan_special_comments(s)),
+                         list(self.obj.iter_special_comments_re(s)),
+                         msg=repr(s))
+
+    def test(self):
+        for s in (
+            u'',
+            u'<!-- dummy <!--$a-->',
+            u'<!--@include -->',
+            u'<!--@include-->',
+            u'<!--@includes a-->',
+            u'<!--$a -->',
+            u'<!--$a = -->',
+            u'<!--$a  :: b -->',
+            u'<!--$a--->',
+            u'<!--$a',
+            u'<!--@include a',
+        ):
+            self.assertSameAsRe(s)
+
+    def test_fuzz(self):
+        import random
+        r = random.Random(0)
+        for i in range(5000):
+            self.assertSameAsRe(u''.join(
+                r.choice(self.tokens) for _ in range(r.randint(0, 40))
+            ))
+
+    def test_parse_str(self):
+        source = (u'<!-- @import a, "b" --><!-- ordinary --><!--$v = 1 -->'
+                  u'<!--$v--><!--@include -->')
+        with mock.patch.object(self.obj, 'iter_special_comments',
+                               self.obj.iter_special_comments_re):
+            expected = self.obj.parse_str(source)
+        self.assertEqual(self.obj.parse_str(source), expected)
+
+    def test_overridden_re(self):
+        import re
+        from ..compiler import Compiler
+
+        class CustomCompiler(Compiler):
+            SPECIAL_COMMENT_RE = re.compile(
+                r'(?P<wrapper>\{\{(?:@include (?P<filenames>.*?)|'
+                r'\$(?P<variable>\w+)(?:=(?P<value>.*?))?)\}\})')
+
+        parsed = CustomCompiler().parse_str(u'{{$v=1}}<!--$v-->{{$v}}')
+        self.assertEqual([(f.command, f.args) for f in parsed],
+                         [('STOR', ('v', '1')), ('NOOP', u'<!--$v-->'),
+                          ('LOAD', 'v'), ('NOOP', u'')])
+
+
+class FragmentListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.obj = Compiler()
+        self.source = u'a\r\n<!--$v=1-->\n  <!--$v--><!--@include x, y-->'
+        self.data = self.obj.parse_str(self.source)
+
+    def test_iter_commands(self):
+        self.assertEqual(list(self.data.iter_commands()), [
+            (0, 'NOOP', u'a\r\n'),
+            (1, 'STOR', (u'v', u'1')),
+            (2, 'NOOP', u'\n  '),
+            (3, 'LOAD', u'v'),
+            (4, 'JUMP', u'x'),
+            (5, 'JUMP', u'y'),
+            (6, 'NOOP', u''),
+        ])
+
+    def test_getitem(self):
+        from ..compiler import Fragment
+        self.assertEqual(self.data[1], Fragment(3, 2, 1, 'STOR', ('v', '1')))
+        self.assertEqual(self.data[-4], Fragment(17, 3, 3, 'LOAD', 'v'))
+        self.assertEqual(self.data[4:6], [
+            Fragment(26, 3, 12, 'JUMP', 'x'),
+            Fragment(26, 3, 12, 'JUMP', 'y'),
+        ])
+        self.assertRaises(IndexError, self.data.__getitem__, 7)
+
+    def test_interned(self):
+        data = self.obj.parse_str(u'<!--$v-->')
+        self.assertIs(data.args[0], self.data.args[1][0])
+
+    def test_set_args(self):
+        self.data.set_args(4, '/x.kit')
+        self.assertEqual(self.data[4].args, '/x.kit')
+        self.assertEqual(self.data[4].command, 'JUMP')
+
+    def test_dumps(self):
+        import marshal
+        from ..compiler import FragmentList
+        loaded = FragmentList.loads(marshal.loads(marshal.dumps(
+            self.data.dumps())))
+        self.assertEqual(loaded, self.data)
+        self.assertFalse(loaded != self.data)
+        self.assertRaises(ValueError, FragmentList.loads,
+                          (u'', '\x00', '', '', [None]))
+
+    def test_noop_not_copied(self):
+        from ..compiler import Compiler
+        self.assertEqual(self.data.args[0], None)
+        obj = Compiler()
+        with mock.patch('codekitlang.compiler.get_file_content',
+                        return_value=('utf-8', self.source)):
+            encoding, data = obj.read_file('x.html', None)
+        self.assertIs(data.source, self.source)
+        self.assertIs(list(data.iter_commands())[0][2], self.source)
+
 
 class ParseFileTestCase(unittest.TestCase):
 
@@ -381,6 +607,322 @@ class ParseFileTestCase(unittest.TestCase):
         self.assertRaises(FileNotFoundError, self.func, filepath)
 
 
+class InvalidateTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.obj = Compiler()
+        super(InvalidateTestCase, self).setUp()
+        self.write('a.kit', 'A<!--@include b-->')
+        self.write('b.kit', 'B<!--@include c-->')
+        self.write('c.kit', 'C')
+        self.write('d.kit', 'D<!--@include c-->')
+
+    def test_dependencies(self):
+        self.obj.parse_file(self.path('a.kit'))
+        self.obj.parse_file(self.path('d.kit'))
+        self.assertEqual(
+            self.obj.parsed_caches[self.path('a.kit')]['dependencies'],
+            set([self.path('b.kit')])
+        )
+        self.assertEqual(self.obj.dependents, {
+            self.path('b.kit'): set([self.path('a.kit')]),
+            self.path('c.kit'): set([self.path('b.kit'), self.path('d.kit')]),
+        })
+
+    def test_refresh_unchanged(self):
+        self.obj.parse_file(self.path('a.kit'))
+        self.assertEqual(self.obj.refresh(), set())
+        self.assertEqual(len(self.obj.parsed_caches), 3)
+
+    def test_refresh_changed(self):
+        self.assertEqual(self.obj.generate_to_str(self.path('a.kit')), 'ABC')
+        self.assertEqual(self.obj.generate_to_str(self.path('d.kit')), 'DC')
+        self.write('c.kit', 'CC')
+        self.assertEqual(
+            self.obj.refresh(),
+            set([self.path('a.kit'), self.path('b.kit'), self.path('c.kit'),
+                 self.path('d.kit')])
+        )
+        self.assertNotIn(self.path('c.kit'), self.obj.parsed_caches)
+        self.assertIn(self.path('b.kit'), self.obj.parsed_caches)
+        self.assertEqual(self.obj.generate_to_str(self.path('a.kit')), 'ABCC')
+
+    def test_refresh_removed(self):
+        self.obj.parse_file(self.path('a.kit'))
+        os.remove(self.path('b.kit'))
+        self.assertEqual(self.obj.refresh(),
+                         set([self.path('a.kit'), self.path('b.kit')]))
+        self.assertNotIn(self.path('b.kit'), self.obj.parsed_caches)
+        # `b` in a.kit is resolved again, to missing
+        self.assertNotIn(self.path('a.kit'), self.obj.parsed_caches)
+        self.assertEqual(self.obj.dependents, {})
+
+    def test_refresh_scoped(self):
+        self.obj.parse_file(self.path('a.kit'))
+        self.obj.parse_file(self.path('d.kit'))
+        self.write('d.kit', 'DD')
+        self.assertEqual(self.obj.refresh([self.path('a.kit')]), set())
+        self.assertIn(self.path('d.kit'), self.obj.parsed_caches)
+        self.write('c.kit', 'CC')
+        self.assertEqual(
+            self.obj.refresh([self.path('a.kit')]),
+            set([self.path('a.kit'), self.path('b.kit'), self.path('c.kit'),
+                 self.path('d.kit')])
+        )
+
+    def test_refresh_scoped_resolutions(self):
+        self.obj.parse_file(self.path('a.kit'))
+        self.obj.parse_file(self.path('d.kit'))
+        os.remove(self.path('b.kit'))
+        # a.kit is out of scope, but looks up `b` in the same directory
+        self.assertIn(self.path('a.kit'),
+                      self.obj.refresh([self.path('d.kit')]))
+        self.assertNotIn(self.path('a.kit'), self.obj.parsed_caches)
+
+    def test_reparse_relinks(self):
+        self.obj.parse_file(self.path('b.kit'))
+        self.write('b.kit', 'BB<!--@include d-->')
+        self.obj.parse_file(self.path('b.kit'))
+        self.assertEqual(self.obj.dependents, {
+            self.path('c.kit'): set([self.path('d.kit')]),
+            self.path('d.kit'): set([self.path('b.kit')]),
+        })
+
+
+class StoredCacheTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        super(StoredCacheTestCase, self).setUp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.write('a.kit', '<!--$v=A--><!--@include b.html--><!--$v-->')
+        self.write('b.html', 'B')
+
+    def compiler(self):
+        from ..compiler import Compiler
+        return Compiler(cache_dir=self.cache_dir)
+
+    def test_stored(self):
+        obj = self.compiler()
+        self.assertEqual(obj.generate_to_str(self.path('a.kit')), 'BA')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        obj = self.compiler()
+        with mock.patch('codekitlang.compiler.get_file_content') as mocked:
+            self.assertEqual(obj.generate_to_str(self.path('a.kit')), 'BA')
+            self.assertFalse(mocked.called)
+        self.assertEqual(
+            obj.parsed_caches[self.path('a.kit')]['data'][1].args,
+            self.path('b.html')
+        )
+
+    def test_same_content(self):
+        self.compiler().parse_file(self.path('a.kit'))
+        stat = os.stat(self.path('a.kit'))
+        os.utime(self.path('a.kit'), (stat.st_atime, stat.st_mtime - 10))
+        obj = self.compiler()
+        with mock.patch('codekitlang.compiler.Compiler.parse_str') as mocked:
+            self.assertEqual(obj.generate_to_str(self.path('a.kit')), 'BA')
+            self.assertFalse(mocked.called)
+
+    def test_changed(self):
+        self.compiler().parse_file(self.path('a.kit'))
+        self.write('a.kit', '<!--$v=AA--><!--@include b.html--><!--$v-->')
+        self.assertEqual(self.compiler().generate_to_str(self.path('a.kit')),
+                         'BAA')
+        self.assertEqual(self.compiler().generate_to_str(self.path('a.kit')),
+                         'BAA')
+
+    def test_broken(self):
+        obj = self.compiler()
+        obj.parse_file(self.path('a.kit'))
+        for filename in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, filename), 'wb') as fp:
+                fp.write('broken')
+        self.assertIsNone(obj.load_stored_cache(self.path('a.kit')))
+        self.assertEqual(self.compiler().generate_to_str(self.path('a.kit')),
+                         'BA')
+
+
+class EncodingTestCase(TempTreeTestCase):
+
+    def test_detect_encoding(self):
+        import codecs
+        from ..compiler import detect_encoding
+        self.assertIsNone(detect_encoding('<p>A</p>'))
+        self.assertEqual(detect_encoding(codecs.BOM_UTF8 + 'A'), 'utf-8-sig')
+        self.assertEqual(detect_encoding(codecs.BOM_UTF16_LE + 'A\x00'),
+                         'utf-16')
+        self.assertEqual(
+            detect_encoding(codecs.BOM_UTF32_LE + 'A\x00\x00\x00'), 'utf-32')
+        self.assertEqual(detect_encoding('<meta charset="Shift_JIS">'),
+                         'shift_jis')
+        self.assertEqual(
+            detect_encoding('<META http-equiv="Content-Type" '
+                            'content="text/html; charset=ISO-8859-1">'),
+            'iso-8859-1')
+        self.assertEqual(detect_encoding('<meta charset=utf-16>'), 'utf-8')
+        self.assertEqual(detect_encoding('@charset "latin-1";\na {}'),
+                         'latin-1')
+        self.assertIsNone(detect_encoding(' @charset "latin-1";'))
+        self.assertIsNone(detect_encoding(' ' * 1024 + '<meta charset=ascii>'))
+
+    def test_get_file_content(self):
+        from ..compiler import get_file_content
+        self.write('ascii.kit', 'A<!--$a-->')
+        self.assertEqual(get_file_content(self.path('ascii.kit')),
+                         ('utf-8', 'A<!--$a-->'))
+        self.assertIsInstance(get_file_content(self.path('ascii.kit'))[1],
+                              str)
+        self.write('sjis.kit', '<meta charset="shift_jis">\x82\xa0')
+        self.assertEqual(get_file_content(self.path('sjis.kit')),
+                         ('shift_jis', u'<meta charset="shift_jis">\u3042'))
+        self.write('bom.kit', u'\u3042'.encode('utf-16'))
+        self.assertEqual(get_file_content(self.path('bom.kit')),
+                         ('utf-16', u'\u3042'))
+        self.write('latin1.kit', 'A\xe4')
+        self.assertEqual(get_file_content(self.path('latin1.kit')),
+                         ('utf-8', u'A\ufffd'))
+        self.assertEqual(
+            get_file_content(self.path('latin1.kit'), ['utf-8', 'latin-1']),
+            ('latin-1', u'A\xe4'))
+
+    def test_stateful_encodings(self):
+        from ..compiler import get_file_content
+        for encoding in ('iso-2022-jp', 'utf-7', 'hz'):
+            content = u'<meta charset="{}">\u3042'.format(encoding)
+            self.write('a.kit', content.encode(encoding))
+            self.assertEqual(get_file_content(self.path('a.kit')),
+                             (encoding, content))
+
+    @testfixtures.log_capture()
+    def test_missing_logonly(self, l):
+        """
+        @type l: testfixtures.LogCapture
+        """
+        from ..compiler import Compiler
+        obj = Compiler(missing_file_behavior='logonly')
+        obj.generate_to_file(self.path('a.html'), self.path('a.kit'))
+        self.assertEqual(self.read('a.html'), '')
+        l.check(
+            ('codekitlang.compiler', 'WARNING',
+             'Compile Error: file "{}" does not found'
+             .format(self.path('a.kit'))),
+        )
+
+    def test_unknown(self):
+        from ..compiler import Compiler, UnknownEncodingError
+        self.write('a.kit', '<meta charset="x-unknown">')
+        self.assertRaises(UnknownEncodingError, Compiler().generate_to_str,
+                          self.path('a.kit'))
+
+    def test_generate_to_file(self):
+        from ..compiler import Compiler
+        self.write('a.kit', '<meta charset="iso-8859-1">\xe4'
+                   '<!--@include b-->')
+        self.write('_b.kit', '\xc3\xb6\xe3\x81\x82')
+        Compiler().generate_to_file(self.path('a.html'), self.path('a.kit'))
+        self.assertEqual(self.read('a.html'),
+                         '<meta charset="iso-8859-1">\xe4\xf6&#12354;')
+        self.write('c.kit', u'\u3042<!--@include b-->'.encode('utf-16'))
+        Compiler().generate_to_file(self.path('c.html'), self.path('c.kit'))
+        self.assertEqual(self.read('c.html').decode('utf-16'),
+                         u'\u3042\xf6\u3042')
+
+    def test_cached(self):
+        from ..compiler import Compiler
+        self.write('a.kit', 'A<!--@include p-->')
+        self.write('b.kit', 'B<!--@include p--><!--@include p-->')
+        self.write('_p.kit', '\xc3\xb6')
+        obj = Compiler()
+        with mock.patch('codekitlang.compiler.detect_encoding',
+                        return_value=None) as mocked:
+            obj.generate_to_str(self.path('a.kit'))
+            obj.generate_to_str(self.path('b.kit'))
+            obj.generate_to_str(self.path('a.kit'))
+            self.assertEqual(mocked.call_count, 3)
+        self.assertEqual(obj.parsed_caches[self.path('_p.kit')]['encoding'],
+                         'utf-8')
+
+
+class MmapTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        super(MmapTestCase, self).setUp()
+        self.write('a.kit', '\xc3\xa4<!--$v=\xc3\xb6-->\n\xc3\xa4 <!--$v-->'
+                   '<!--@include b--><!--$w-->')
+        self.write('_b.kit', 'B<!--$v-->')
+
+    def test_generate(self):
+        import mmap
+        from ..compiler import Compiler
+        obj = Compiler(mmap_threshold=1)
+        self.assertEqual(obj.generate_to_str(self.path('a.kit')),
+                         Compiler().generate_to_str(self.path('a.kit')))
+        self.assertEqual(obj.generate_to_str(self.path('a.kit')),
+                         u'\xe4\n\xe4 \xf6B\xf6')
+        data = obj.parsed_caches[self.path('a.kit')]['data']
+        self.assertIsInstance(data.source, mmap.mmap)
+        self.assertEqual(data[1].args, (u'v', u'\xf6'))
+
+    def test_rewritten_in_place(self):
+        from ..compiler import Compiler
+        self.write('_big.kit', 'X' * 5000 + '<!--$v-->')
+        self.write('page.kit', '<!--$v=V--><!--@include big-->')
+        obj = Compiler(mmap_threshold=1)
+        self.assertEqual(obj.generate_to_str(self.path('page.kit')),
+                         'X' * 5000 + 'V')
+        # same file truncated, reading the old mapping would raise SIGBUS
+        with open(self.path('_big.kit'), 'r+b') as fp:
+            fp.truncate(0)
+            fp.write('short<!--$v-->')
+        self.assertEqual(obj.generate_to_str(self.path('page.kit')),
+                         'shortV')
+        with open(self.path('_big.kit'), 'r+b') as fp:
+            fp.write('SHORT')
+        os.utime(self.path('_big.kit'), (0, 0))
+        self.assertEqual(obj.generate_to_str(self.path('page.kit')),
+                         'SHORTV')
+
+    def test_threshold(self):
+        from ..compiler import Compiler
+        obj = Compiler(mmap_threshold=20)
+        obj.parse_file(self.path('a.kit'))
+        self.assertIsNotNone(
+            obj.parsed_caches[self.path('a.kit')]['data'].encoding)
+        self.assertIsNone(
+            obj.parsed_caches[self.path('_b.kit')]['data'].encoding)
+
+    def test_position(self):
+        from ..compiler import Compiler
+        for obj in (Compiler(), Compiler(mmap_threshold=1)):
+            obj.parse_file(self.path('a.kit'))
+            fragment = obj.parsed_caches[self.path('a.kit')]['data'][-2]
+            self.assertEqual((fragment.line, fragment.column), (2, 29))
+
+    def test_other_encoding(self):
+        from ..compiler import Compiler
+        self.write('c.kit', '<meta charset="latin-1">\xe4')
+        self.write('d.kit', u'\xe4'.encode('utf-8-sig'))
+        obj = Compiler(mmap_threshold=1)
+        self.assertEqual(obj.generate_to_str(self.path('c.kit')),
+                         u'<meta charset="latin-1">\xe4')
+        self.assertEqual(obj.generate_to_str(self.path('d.kit')), u'\xe4')
+        for filename in ('c.kit', 'd.kit'):
+            self.assertIsNone(
+                obj.parsed_caches[self.path(filename)]['data'].encoding)
+
+    def test_stored(self):
+        from ..compiler import Compiler
+        cache_dir = self.path('cache')
+        obj = Compiler(cache_dir=cache_dir, mmap_threshold=1)
+        expected = obj.generate_to_str(self.path('a.kit'))
+        obj = Compiler(cache_dir=cache_dir, mmap_threshold=1)
+        with mock.patch('codekitlang.compiler.Compiler.parse_str') as mocked:
+            self.assertEqual(obj.generate_to_str(self.path('a.kit')),
+                             expected)
+            self.assertFalse(mocked.called)
+
+
 class GenerateToStrTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -448,6 +990,288 @@ BBB
         self.assertRaises(CyclicInclusionError, self.func, filepath)
 
 
+class ScopeTestCase(TempTreeTestCase):
+
+    def test_layers(self):
+        from ..compiler import Scope
+        context = {'a': 'A'}
+        root = Scope(context)
+        root['b'] = 'B'
+        self.assertEqual(context, {'a': 'A', 'b': 'B'})
+        child = root.child()
+        child['a'] = 'AA'
+        grandchild = child.child()
+        self.assertEqual(grandchild['a'], 'AA')
+        self.assertEqual(grandchild['b'], 'B')
+        self.assertEqual(root['a'], 'A')
+        self.assertNotIn('c', grandchild)
+        self.assertIsNone(grandchild.get('c'))
+        self.assertRaises(KeyError, grandchild.__getitem__, 'c')
+
+    def test_shared(self):
+        from ..compiler import Scope
+        root = Scope({'a': 'A'})
+        child = root.child()
+        self.assertIs(child.child().base, child.base)
+        child['b'] = 'B'
+        merged = child.merged()
+        self.assertEqual(merged, {'a': 'A', 'b': 'B'})
+        child['c'] = 'C'
+        self.assertEqual(child.merged(), {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertEqual(merged, {'a': 'A', 'b': 'B'})
+
+    def test_generate(self):
+        from ..compiler import Compiler
+        self.write('a.kit', '<!--$v=A--><!--@include b--><!--$v-->')
+        self.write('_b.kit', '<!--$v--><!--$v=B--><!--@include c--><!--$v-->')
+        self.write('_c.kit', '<!--$v-->')
+        context = dict()
+        self.assertEqual(''.join(Compiler().generate_iter(
+            self.path('a.kit'), context)), 'ABBA')
+        self.assertEqual(context, {'v': 'A'})
+
+
+class GenerateIterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.dp = os.path.join(os.path.dirname(__file__), 'data')
+        self.basepath = os.path.join(self.dp, 'b')
+        self.obj = Compiler()
+        self.filepath = os.path.join(self.basepath, 'parse_unicode.kit')
+        with open(os.path.join(self.dp, 'd', 'parse_unicode_result.html'),
+                  'rb') as fp:
+            self.forecast = fp.read()
+
+    def test_generate_iter(self):
+        ret = list(self.obj.generate_iter(self.filepath))
+        self.assertEqual(ret, [u'123\n', u'ABC \xc6\xd8\xc5 XYZ\n',
+                               u'\n456\n'])
+
+    def test_generate_to_stream(self):
+        fp = mock.Mock()
+        self.obj.generate_to_stream(fp, self.filepath)
+        self.assertEqual(fp.write.call_count, 3)
+        self.assertEqual(''.join(c[0][0] for c in fp.write.call_args_list),
+                         self.forecast)
+
+    def test_generate_to_stream_buffered(self):
+        fp = mock.Mock()
+        self.obj.generate_to_stream(fp, self.filepath, buffer_size=10)
+        self.assertEqual(
+            [c[0][0] for c in fp.writelines.call_args_list],
+            [['123\n', 'ABC \xc3\x86\xc3\x98\xc3\x85 XYZ\n'], ['\n456\n']]
+        )
+        self.assertFalse(fp.write.called)
+
+    def test_generate_to_file_error(self):
+        from ..compiler import VariableNotFoundError
+        self.obj.missing_variable_behavior = 'exception'
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(
+                VariableNotFoundError, self.obj.generate_to_file,
+                os.path.join(tempdir, 'out.html'),
+                os.path.join(self.basepath, 'generate_to_str_missing_var.kit')
+            )
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+class DeepInclusionTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        import sys
+        super(DeepInclusionTestCase, self).setUp()
+        self.depth = sys.getrecursionlimit() + 100
+        for i in range(self.depth):
+            s = '<!--$v-->'
+            if i + 1 < self.depth:
+                s += '<!--@include f{}-->'.format(i + 1)
+            self.write('_f{}.kit'.format(i), s)
+        self.write('page.kit', '<!--$v=V--><!--@include f0-->')
+
+    def test_generate(self):
+        from ..compiler import Compiler
+        obj = Compiler()
+        filepath = os.path.join(self.tempdir, 'page.kit')
+        self.assertEqual(obj.generate_to_str(filepath), 'V' * self.depth)
+        self.assertEqual(len(obj.parsed_caches), self.depth + 1)
+        self.assertIsNone(
+            obj.folded_caches[os.path.join(self.tempdir, '_f1.kit')])
+
+    def test_render(self):
+        from ..compiler import Compiler
+        obj = Compiler()
+        filepath = os.path.join(self.tempdir, 'page.kit')
+        self.assertEqual(obj.render(filepath), 'V' * self.depth)
+
+    def test_cyclic(self):
+        from ..compiler import Compiler, CyclicInclusionError
+        self.write('_f{}.kit'.format(self.depth - 1), '<!--@include f0-->')
+        obj = Compiler()
+        try:
+            obj.generate_to_str(os.path.join(self.tempdir, 'page.kit'))
+        except CyclicInclusionError as e:
+            self.assertEqual(len(e.stack), self.depth + 1)
+        else:
+            self.fail('CyclicInclusionError not raised')
+
+
+class RenderPlanTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.dp = os.path.join(os.path.dirname(__file__), 'data')
+        self.basepath = os.path.join(self.dp, 'b')
+        self.obj = Compiler()
+        super(RenderPlanTestCase, self).setUp()
+
+    def test_static(self):
+        filepath = os.path.join(self.basepath, 'parse_file_test3.kit')
+        plan = self.obj.get_render_plan(filepath)
+        self.assertEqual(plan.slots, ())
+        self.assertEqual(len(plan.parts), 1)
+        self.assertEqual(plan.filepaths, frozenset([
+            filepath, os.path.join(self.basepath, 'parse_file_test2.html'),
+        ]))
+        self.assertEqual(self.obj.render(filepath),
+                         self.obj.generate_to_str(filepath))
+
+    def test_slots(self):
+        self.write('a.kit', 'A<!--$x--><!--@include b--><!--$y=Y--><!--$y-->')
+        self.write('b.kit', '<!--$y=B--><!--$x-->-<!--$y-->')
+        plan = self.obj.get_render_plan(self.path('a.kit'))
+        self.assertEqual(plan.parts, (u'A', u'', u'', u'-BY'))
+        self.assertEqual([slot[:3] for slot in plan.slots], [
+            (1, 'x', self.path('a.kit')),
+            (2, 'x', self.path('b.kit')),
+        ])
+        self.assertEqual(self.obj.render(self.path('a.kit'), {'x': 'X'}),
+                         'AXX-BY')
+        self.assertEqual(self.obj.render(self.path('a.kit')), 'A-BY')
+        self.assertEqual(self.obj.render(self.path('a.kit')),
+                         self.obj.generate_to_str(self.path('a.kit')))
+
+    def test_missing_var_exception(self):
+        from ..compiler import VariableNotFoundError
+        self.obj.missing_variable_behavior = 'exception'
+        self.write('a.kit', 'A<!--$x-->')
+        self.assertRaises(VariableNotFoundError, self.obj.render,
+                          self.path('a.kit'))
+        self.assertEqual(self.obj.render(self.path('a.kit'), {'x': 'X'}),
+                         'AX')
+
+    def test_cached(self):
+        self.write('a.kit', 'A<!--@include b-->')
+        self.write('b.kit', 'B')
+        plan = self.obj.get_render_plan(self.path('a.kit'))
+        self.assertIs(self.obj.get_render_plan(self.path('a.kit')), plan)
+        self.obj.refresh()
+        self.assertIs(self.obj.get_render_plan(self.path('a.kit')), plan)
+        self.write('b.kit', 'BB')
+        self.obj.refresh()
+        self.assertEqual(self.obj.render(self.path('a.kit')), 'ABB')
+
+    def test_reparsed(self):
+        self.write('a.kit', 'A<!--@include b-->')
+        self.write('b.kit', 'B')
+        self.assertEqual(self.obj.render(self.path('a.kit')), 'AB')
+        self.write('b.kit', 'BB')
+        self.obj.parse_file(self.path('b.kit'))
+        self.assertEqual(self.obj.render(self.path('a.kit')), 'ABB')
+
+    def test_cyclic_inclusion(self):
+        from ..compiler import CyclicInclusionError
+        filepath = os.path.join(self.basepath,
+                                'generate_to_str_cyclic_inclusion2a.kit')
+        self.assertRaises(CyclicInclusionError, self.obj.get_render_plan,
+                          filepath)
+        self.assertEqual(self.obj.render_plans, {})
+
+    def test_missing_file(self):
+        self.obj.missing_file_behavior = 'ignore'
+        filepath = os.path.join(self.basepath, 'parse_file_missing_file.kit')
+        self.assertEqual(self.obj.render(filepath), 'AAA\n\nBBB\n')
+        self.assertEqual(self.obj.generate_to_str(filepath),
+                         'AAA\n\nBBB\n')
+
+
+class FoldTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.obj = Compiler()
+        super(FoldTestCase, self).setUp()
+        self.write('page.kit', '<!--$x=X--><!--@include footer, nav-->')
+        self.write('footer.kit', 'F<!--@include legal--><!--$y=Y--><!--$y-->')
+        self.write('legal.kit', 'L')
+        self.write('nav.kit', 'N<!--$x-->')
+
+    def test_fold_caches(self):
+        self.obj.parse_file(self.path('page.kit'))
+        self.obj.fold_caches()
+        # legal is included only by folded footer
+        self.assertEqual(sorted(self.obj.folded_caches), [
+            self.path('footer.kit'), self.path('nav.kit'),
+        ])
+        self.assertEqual(self.obj.get_folded(self.path('footer.kit')), 'FLY')
+        self.assertEqual(self.obj.folded_caches[self.path('footer.kit')]
+                         .filepaths, frozenset([self.path('footer.kit'),
+                                                self.path('legal.kit')]))
+        self.assertIsNone(self.obj.get_folded(self.path('nav.kit')))
+
+    def test_fold_caches_nested(self):
+        size = 100000
+        self.write('_w10.kit', 'B' * size)
+        for i in range(10):
+            self.write('_w{}.kit'.format(i),
+                       '<!--@include w{}-->'.format(i + 1))
+        self.write('a.kit', '<!--@include w0-->')
+        self.write('b.kit', '<!--$x=X--><!--@include w5, nav-->')
+        self.obj.parse_file(self.path('a.kit'))
+        self.obj.parse_file(self.path('b.kit'))
+        self.obj.fold_caches()
+        folded = dict((os.path.basename(f), plan)
+                      for f, plan in self.obj.folded_caches.items()
+                      if plan is not None)
+        self.assertEqual(sorted(folded), ['_w0.kit', '_w5.kit'])
+        self.assertEqual(sum(len(plan.parts[0]) for plan in folded.values()),
+                         size * 2)
+        self.assertEqual(self.obj.generate_to_str(self.path('b.kit')),
+                         'B' * size + 'NX')
+
+    def test_generate(self):
+        self.assertEqual(
+            filter(None, self.obj.generate_iter(self.path('page.kit'))),
+            ['FLY', 'N', 'X']
+        )
+        self.assertEqual(self.obj.render(self.path('page.kit')), 'FLYNX')
+
+    def test_invalidate(self):
+        self.assertEqual(self.obj.generate_to_str(self.path('page.kit')),
+                         'FLYNX')
+        self.write('legal.kit', 'LL')
+        self.obj.refresh()
+        self.assertNotIn(self.path('footer.kit'), self.obj.folded_caches)
+        self.assertEqual(self.obj.generate_to_str(self.path('page.kit')),
+                         'FLLYNX')
+
+    def test_cyclic_inclusion(self):
+        from ..compiler import CyclicInclusionError
+        self.write('legal.kit', '<!--@include footer-->')
+        self.assertIsNone(self.obj.get_folded(self.path('footer.kit')))
+        try:
+            self.obj.generate_to_str(self.path('page.kit'))
+        except CyclicInclusionError as e:
+            self.assertEqual(e.stack, (self.path('page.kit'),
+                                       self.path('footer.kit'),
+                                       self.path('legal.kit')))
+        else:
+            self.fail('CyclicInclusionError not raised')
+
+
 class GenerateToFileTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -486,3 +1310,643 @@ class GenerateToFileTestCase(unittest.TestCase):
 
         self.assertGenerateToFile('parse_unicode_result.html',
                                   'parse_unicode.kit')
+
+
+class GenerateToDirTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        self.dp = os.path.join(os.path.dirname(__file__), 'data')
+        self.obj = Compiler()
+        super(GenerateToDirTestCase, self).setUp()
+        self.srcdir = os.path.join(self.tempdir, 'src')
+        self.destdir = os.path.join(self.tempdir, 'dest')
+        os.makedirs(os.path.join(self.srcdir, 'sub'))
+        self.write('src/_header.kit', 'H<!--$title-->')
+        self.write('src/index.kit', '<!--$title=T1--><!--@include header-->')
+        self.write('src/sub/page.kit',
+                   '<!--$title=T2--><!--@include ../header-->')
+        self.write('src/sub/asset.html', 'asset')
+
+    def test_list_pages(self):
+        self.assertEqual(self.obj.list_pages(self.destdir, self.srcdir), [
+            (os.path.join(self.destdir, 'index.html'),
+             os.path.join(self.srcdir, 'index.kit')),
+            (os.path.join(self.destdir, 'sub', 'page.html'),
+             os.path.join(self.srcdir, 'sub', 'page.kit')),
+        ])
+
+    def test_list_pages_dest_in_src(self):
+        destdir = os.path.join(self.srcdir, 'out')
+        os.makedirs(destdir)
+        self.write('src/out/index.kit', 'generated')
+        self.assertEqual(len(self.obj.list_pages(destdir, self.srcdir)), 2)
+
+    def test_generate_to_dir(self):
+        self.obj.generate_to_dir(self.destdir, self.srcdir)
+        self.assertEqual(self.read('dest/index.html'), 'HT1')
+        self.assertEqual(self.read('dest/sub/page.html'), 'HT2')
+        self.assertEqual(sorted(os.listdir(self.destdir)),
+                         ['index.html', 'sub'])
+        self.assertEqual(
+            self.obj.dependents[os.path.join(self.srcdir, '_header.kit')],
+            set([os.path.join(self.srcdir, 'index.kit'),
+                 os.path.join(self.srcdir, 'sub', 'page.kit')])
+        )
+
+    def test_generate_to_dir_parallel(self):
+        self.obj.generate_to_dir(self.destdir, self.srcdir, jobs=2)
+        self.assertEqual(self.read('dest/index.html'), 'HT1')
+        self.assertEqual(self.read('dest/sub/page.html'), 'HT2')
+
+    def test_generate_to_dir_errors(self):
+        self.check_errors(jobs=None)
+
+    def test_generate_to_dir_parallel_errors(self):
+        self.check_errors(jobs=2)
+
+    def check_errors(self, jobs):
+        from ..compiler import CompileErrors
+        from ..compiler import FileNotFoundError
+        from ..compiler import VariableNotFoundError
+        self.obj.missing_file_behavior = 'exception'
+        self.obj.missing_variable_behavior = 'exception'
+        self.write('src/a.kit', '<!--$missing-->')
+        self.write('src/b.kit', '<!--@include missing-->')
+        self.write('src/c.kit', 'C')
+        try:
+            self.obj.generate_to_dir(self.destdir, self.srcdir, jobs=jobs)
+        except CompileErrors as e:
+            self.assertEqual([type(x) for x in e.errors],
+                             [VariableNotFoundError, FileNotFoundError])
+            self.assertEqual(len(e.to_message().splitlines()), 2)
+        else:
+            self.fail('CompileErrors not raised')
+        self.assertEqual(self.read('dest/c.html'), 'C')
+        self.assertEqual(self.read('dest/index.html'), 'HT1')
+
+
+class ManifestTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        super(ManifestTestCase, self).setUp()
+        self.manifest = self.path('manifest.json')
+        os.makedirs(self.path('src'))
+        self.write('src/_p.kit', 'P')
+        self.write('src/a.kit', 'A<!--@include p-->')
+        self.write('src/b.kit', 'B')
+
+    def build(self, **kw):
+        from ..compiler import Compiler
+        obj = Compiler(**kw)
+        obj.load_manifest(self.manifest)
+        obj.generate_to_dir(self.path('dest'), self.path('src'))
+        obj.dump_manifest(self.manifest)
+        return obj
+
+    def test_entry(self):
+        obj = self.build()
+        entry = obj.manifest[self.path('dest/a.html')]
+        self.assertEqual(entry['src'], self.path('src/a.kit'))
+        self.assertEqual(sorted(entry['inputs']),
+                         [self.path('src/_p.kit'), self.path('src/a.kit')])
+
+    def test_skip(self):
+        self.build()
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter') \
+                as mocked:
+            self.build()
+            self.assertFalse(mocked.called)
+
+    def test_included_changed(self):
+        self.build()
+        self.write('src/_p.kit', 'PP')
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter',
+                        return_value=[u'X']) as mocked:
+            self.build()
+            mocked.assert_called_once_with(self.path('src/a.kit'),
+                                           inputs={})
+        self.assertEqual(self.read('dest/a.html'), 'X')
+
+    def test_evicted_while_generating(self):
+        self.write('src/_q.kit', 'Q<!--@include p-->')
+        self.write('src/c.kit', 'C<!--@include q-->')
+        obj = self.build(cache_size=1)
+        self.assertEqual(self.read('dest/c.html'), 'CQP')
+        inputs = obj.manifest[self.path('dest/c.html')]['inputs']
+        self.assertEqual(sorted(inputs),
+                         [self.path('src/_p.kit'), self.path('src/_q.kit'),
+                          self.path('src/c.kit')])
+        self.assertNotIn(None, inputs.values())
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter') \
+                as mocked:
+            self.build(cache_size=1)
+            self.assertFalse(mocked.called)
+        self.write('src/_p.kit', 'PP')
+        self.build(cache_size=1)
+        self.assertEqual(self.read('dest/c.html'), 'CQPP')
+
+    def test_unknown_input(self):
+        self.build()
+        with open(self.manifest, 'rb') as fp:
+            stored = json.load(fp)
+        stored['outputs'][self.path('dest/b.html')]['inputs'][
+            self.path('src/b.kit')] = None
+        with open(self.manifest, 'wb') as fp:
+            json.dump(stored, fp)
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter',
+                        return_value=[u'X']) as mocked:
+            self.build()
+            mocked.assert_called_once_with(self.path('src/b.kit'),
+                                           inputs={})
+
+    def test_missing_src(self):
+        from ..compiler import Compiler
+
+        def build():
+            obj = Compiler(missing_file_behavior='ignore')
+            obj.load_manifest(self.manifest)
+            obj.generate_to_file(self.path('dest/c.html'),
+                                 self.path('src/c.kit'))
+            obj.dump_manifest(self.manifest)
+            return self.read('dest/c.html')
+
+        self.assertEqual(build(), '')
+        self.assertEqual(build(), '')
+        self.write('src/c.kit', 'A')
+        self.assertEqual(build(), 'A')
+
+    def test_resolved_to_other_file(self):
+        self.write('fw/_header.kit', 'FW')
+        self.write('src/c.kit', 'A<!-- @import header -->B')
+        self.build(framework_paths=[self.path('fw')])
+        self.assertEqual(self.read('dest/c.html'), 'AFWB')
+        self.write('src/_header.kit', 'LOCAL')
+        obj = self.build(framework_paths=[self.path('fw')])
+        self.assertEqual(self.read('dest/c.html'), 'ALOCALB')
+        self.assertEqual(
+            obj.manifest[self.path('dest/c.html')]['resolutions'],
+            [['header', self.path('src'), self.path('src/_header.kit')]])
+
+    def test_missing_resolved(self):
+        self.write('src/c.kit', 'X<!-- @import missing -->Y')
+        self.build()
+        self.assertEqual(self.read('dest/c.html'), 'XY')
+        self.write('src/_missing.kit', 'M')
+        self.build()
+        self.assertEqual(self.read('dest/c.html'), 'XMY')
+
+    def test_directory_changed(self):
+        self.build()
+        self.write('src/other.txt', 'O')
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter') \
+                as mocked:
+            obj = self.build()
+            self.assertFalse(mocked.called)
+        # directory mtimes are updated when resolutions are not changed
+        self.assertEqual(
+            obj.manifest[self.path('dest/a.html')]['directories'],
+            {self.path('src'): os.stat(self.path('src')).st_mtime})
+
+    def test_output_removed(self):
+        self.build()
+        os.remove(self.path('dest/b.html'))
+        self.build()
+        self.assertEqual(self.read('dest/b.html'), 'B')
+
+    def test_options_changed(self):
+        self.build()
+        obj = self.build(missing_variable_behavior='logonly')
+        self.assertEqual(len(obj.manifest), 2)
+        with mock.patch('codekitlang.compiler.Compiler.generate_iter',
+                        return_value=[u'X']) as mocked:
+            self.build()
+            self.assertEqual(mocked.call_count, 2)
+
+    def test_broken(self):
+        self.write('manifest.json', '{')
+        self.build()
+        self.assertEqual(self.read('dest/a.html'), 'AP')
+
+    def test_parallel(self):
+        from ..compiler import Compiler
+        obj = Compiler()
+        obj.load_manifest(self.manifest)
+        obj.generate_to_dir(self.path('dest'), self.path('src'), jobs=2)
+        self.assertEqual(sorted(obj.manifest), [self.path('dest/a.html'),
+                                                self.path('dest/b.html')])
+
+    def test_same_content_not_written(self):
+        from ..compiler import Compiler
+        obj = Compiler()
+        obj.generate_to_file(self.path('dest/b.html'), self.path('src/b.kit'))
+        os.utime(self.path('dest/b.html'), (0, 0))
+        obj.generate_to_file(self.path('dest/b.html'), self.path('src/b.kit'))
+        self.assertEqual(os.stat(self.path('dest/b.html')).st_mtime, 0)
+        self.write('src/b.kit', 'C')
+        obj.refresh()
+        obj.generate_to_file(self.path('dest/b.html'), self.path('src/b.kit'))
+        self.assertNotEqual(os.stat(self.path('dest/b.html')).st_mtime, 0)
+        self.assertEqual(self.read('dest/b.html'), 'C')
+
+
+class StatsTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(StatsTestCase, self).setUp()
+        os.makedirs(self.path('src'))
+        self.write('src/_p.kit', 'P')
+        self.write('src/a.kit', 'A<!--@include p-->')
+        self.write('src/b.kit', 'B<!--@include p-->')
+        self.stats = Stats()
+        self.obj = Compiler(stats=self.stats)
+
+    def test_counters(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        counters = self.stats.counters
+        self.assertEqual(counters['parsed_cache_misses'], 3)
+        self.assertEqual(counters['parsed_cache_hits'], 1)
+        self.assertEqual(counters['resolved_path_misses'], 1)
+        self.assertEqual(counters['bytes_read'], 1 + 18 + 18)
+        self.assertTrue(counters['stat_calls'] > 0)
+        self.assertEqual(sorted(self.stats.parse_times),
+                         [self.path('src/_p.kit'), self.path('src/a.kit'),
+                          self.path('src/b.kit')])
+        self.assertEqual(sorted(self.stats.generate_times),
+                         [self.path('src/a.kit'), self.path('src/b.kit')])
+        self.assertTrue(set(self.stats.times) >=
+                        set(['read', 'parse', 'resolve', 'generate']))
+
+    def test_disabled(self):
+        from ..compiler import Compiler
+        obj = Compiler()
+        self.assertIsNone(obj.stats)
+        obj.generate_to_dir(self.path('dest'), self.path('src'))
+
+    def test_parallel(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'), jobs=2)
+        self.assertEqual(sorted(self.stats.generate_times),
+                         [self.path('src/a.kit'), self.path('src/b.kit')])
+        self.assertEqual(self.stats.counters['parsed_cache_misses'], 3)
+
+    def test_get_profile(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        profile = self.obj.get_profile(top=1)
+        self.assertEqual(len(profile['parse']), 1)
+        self.assertEqual(len(profile['generate']), 1)
+        subtrees = dict(self.obj.get_profile()['subtrees'])
+        self.assertEqual(sorted(subtrees),
+                         [self.path('src/a.kit'), self.path('src/b.kit')])
+        self.assertEqual(
+            subtrees[self.path('src/a.kit')],
+            self.stats.parse_times[self.path('src/a.kit')] +
+            self.stats.parse_times[self.path('src/_p.kit')])
+
+
+class ThreadSafetyTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(ThreadSafetyTestCase, self).setUp()
+        self.write('_header.kit', '<!--$title-->|<!--@include nav-->')
+        self.write('_nav.kit', 'N')
+        for i in range(8):
+            self.write('p{}.kit'.format(i),
+                       '<!--$title={}-->P<!--@include header-->'.format(i))
+        self.stats = Stats()
+        self.obj = Compiler(missing_file_behavior='exception',
+                            stats=self.stats)
+
+    def run_threads(self, target, n):
+        import threading
+        errors = []
+        start = threading.Event()
+
+        def run(i):
+            start.wait()
+            try:
+                target(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_generate(self):
+        results = dict()
+
+        def target(i):
+            outputs = set()
+            for _ in range(50):
+                for j in range(8):
+                    outputs.add(self.obj.generate_to_str(
+                        self.path('p{}.kit'.format(j))))
+            results[i] = outputs
+
+        self.run_threads(target, 8)
+        expected = set('P{}|N'.format(j) for j in range(8))
+        self.assertEqual(results, dict((i, expected) for i in range(8)))
+        # each file is parsed once, other threads wait for it
+        self.assertEqual(self.stats.counters['parsed_cache_misses'], 10)
+
+    def test_parse_locks(self):
+        from ..compiler import PARSE_LOCK_STRIPES
+        for j in range(PARSE_LOCK_STRIPES * 2):
+            self.write('q{}.kit'.format(j), 'Q')
+            self.obj.parse_file(self.path('q{}.kit'.format(j)))
+            self.obj.invalidate([self.path('q{}.kit'.format(j))])
+        self.assertEqual(len(self.obj.parse_locks), PARSE_LOCK_STRIPES)
+        self.assertIs(self.obj.get_parse_lock(self.path('q0.kit')),
+                      self.obj.get_parse_lock(self.path('q0.kit')))
+
+    def test_refresh(self):
+        import re
+        pattern = re.compile(r'P\d\|N+\Z')
+
+        def target(i):
+            for k in range(30):
+                if i == 0:
+                    # replace atomically, not to read a truncated file
+                    self.write('_nav.tmp', 'N' * (k % 5 + 1))
+                    os.rename(self.path('_nav.tmp'), self.path('_nav.kit'))
+                    self.obj.refresh()
+                else:
+                    s = self.obj.generate_to_str(
+                        self.path('p{}.kit'.format(i)))
+                    self.assertTrue(pattern.match(s), s)
+
+        self.run_threads(target, 8)
+        self.write('_nav.kit', 'N' * 8)
+        self.obj.refresh()
+        self.assertEqual(self.obj.generate_to_str(self.path('p1.kit')),
+                         'P1|NNNNNNNN')
+
+
+class CacheSizeTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(CacheSizeTestCase, self).setUp()
+        self.write('_p.kit', 'P' * 1000)
+        for name in 'abcd':
+            self.write(name + '.kit',
+                       name * 1000 + '<!--@include p-->')
+        self.stats = Stats()
+        self.obj = Compiler(missing_file_behavior='exception',
+                            stats=self.stats)
+        self.size = self.obj.parse_str('x' * 1000).get_size()
+
+    def test_unbounded(self):
+        for name in 'abcd':
+            self.obj.generate_to_str(self.path(name + '.kit'))
+        self.assertEqual(len(self.obj.parsed_caches), 5)
+        self.assertEqual(
+            self.obj.cache_bytes,
+            sum(cache['size'] for cache in self.obj.parsed_caches.values()))
+        self.assertEqual(self.obj.cache_uses, {})
+        self.assertEqual(self.stats.counters['parsed_cache_evictions'], 0)
+
+    def test_evict(self):
+        self.obj.cache_size = self.size * 4
+        for name in 'abcd':
+            self.assertEqual(
+                self.obj.generate_to_str(self.path(name + '.kit')),
+                name * 1000 + 'P' * 1000)
+        self.assertTrue(self.obj.cache_bytes <= self.obj.cache_size)
+        # a and b are least recently used, the partial is used by d
+        self.assertEqual(sorted(self.obj.parsed_caches),
+                         [self.path('_p.kit'), self.path('c.kit'),
+                          self.path('d.kit')])
+        self.assertEqual(self.stats.counters['parsed_cache_evictions'], 2)
+        self.assertEqual(
+            self.obj.cache_bytes,
+            sum(cache['size'] for cache in self.obj.parsed_caches.values()))
+
+    def test_evicted_child(self):
+        self.obj.generate_to_str(self.path('a.kit'))
+        self.obj.cache_size = 0
+        self.assertEqual(self.obj.evict(keep=self.path('a.kit')),
+                         [self.path('_p.kit')])
+        self.assertNotIn(self.path('a.kit'), self.obj.render_plans)
+        # parsed again on demand, including file is not changed
+        self.assertEqual(self.obj.generate_to_str(self.path('a.kit')),
+                         'a' * 1000 + 'P' * 1000)
+        self.assertEqual(self.stats.counters['parsed_cache_misses'], 3)
+
+    def test_folded_use(self):
+        self.obj.cache_size = self.size * 6
+        self.write('_q.kit', 'Q' * 1000)
+        self.write('_m.kit', 'M<!--@include q-->')
+        self.write('e.kit', '<!--@include m-->')
+        self.write('big.kit', 'B' * 3000 + '<!--@include p-->')
+        self.obj.generate_to_str(self.path('e.kit'))
+        self.obj.generate_to_str(self.path('big.kit'))
+        self.obj.generate_to_str(self.path('e.kit'))
+        self.obj.generate_to_str(self.path('c.kit'))
+        # q is used by e through folded output of m, big is evicted
+        self.assertNotIn(self.path('big.kit'), self.obj.parsed_caches)
+        self.assertIn(self.path('_q.kit'), self.obj.parsed_caches)
+        self.assertEqual(self.stats.counters['parsed_cache_evictions'], 1)
+
+    def test_low_water_mark(self):
+        from ..compiler import CACHE_LOW_WATER_MARK
+        self.obj.cache_size = self.size * 8
+        for name in 'abcdefghi':
+            self.write(name + '.kit', name * 1000)
+            self.obj.parse_file(self.path(name + '.kit'))
+        self.assertEqual(self.stats.counters['parsed_cache_evictions'], 3)
+        self.assertTrue(self.obj.cache_bytes <=
+                        self.obj.cache_size * CACHE_LOW_WATER_MARK)
+        self.assertEqual(list(self.obj.cache_uses),
+                         [self.path(name + '.kit') for name in 'defghi'])
+
+
+class StatWindowTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(StatWindowTestCase, self).setUp()
+        os.makedirs(self.path('src'))
+        self.write('src/_p.kit', 'P')
+        self.write('src/a.kit', 'A<!--@include p--><!--@include p-->')
+        self.write('src/b.kit', 'B<!--@include p-->')
+        self.stats = Stats()
+        self.obj = Compiler(missing_file_behavior='exception',
+                            stats=self.stats, stat_window=0)
+
+    def test_once_per_build(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.assertEqual(self.read('dest/a.html'), 'APP')
+        # each file and directory once
+        self.assertEqual(self.stats.counters['stat_calls'],
+                         len(self.obj.stat_results))
+        self.write('src/_p.kit', 'PP')
+        self.assertEqual(self.obj.generate_to_str(self.path('src/b.kit')),
+                         'BP')
+        self.assertEqual(self.obj.refresh(),
+                         set([self.path('src/_p.kit'), self.path('src/a.kit'),
+                              self.path('src/b.kit')]))
+        self.assertEqual(self.obj.generate_to_str(self.path('src/b.kit')),
+                         'BPP')
+
+    def test_window(self):
+        self.obj.stat_window = 60
+        self.assertEqual(self.obj.generate_to_str(self.path('src/b.kit')),
+                         'BP')
+        self.write('src/_p.kit', 'PP')
+        self.assertEqual(self.obj.refresh(), set())
+        # notified changes are stat'ed again
+        self.obj.invalidate([self.path('src/_p.kit')])
+        self.assertEqual(self.obj.generate_to_str(self.path('src/b.kit')),
+                         'BPP')
+
+    def test_disabled(self):
+        self.obj.stat_window = None
+        self.obj.generate_to_str(self.path('src/b.kit'))
+        self.write('src/_p.kit', 'PP')
+        self.assertEqual(
+            self.obj.refresh(),
+            set([self.path('src/_p.kit'), self.path('src/b.kit')]))
+        self.assertEqual(self.obj.stat_results, {})
+
+    def test_missing(self):
+        from ..compiler import FileNotFoundError
+        self.assertRaises(FileNotFoundError, self.obj.generate_to_str,
+                          self.path('src/c.kit'))
+        self.write('src/c.kit', 'C')
+        self.assertRaises(FileNotFoundError, self.obj.generate_to_str,
+                          self.path('src/c.kit'))
+        self.obj.start_build()
+        self.assertEqual(self.obj.generate_to_str(self.path('src/c.kit')),
+                         'C')
+
+
+class ExpansionTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(ExpansionTestCase, self).setUp()
+        os.makedirs(self.path('src'))
+        self.write('src/_body.kit', 'B<!--$lang--><!--@include nav-->')
+        self.write('src/_nav.kit', 'N')
+        for name, lang in (('a', 'en'), ('b', 'fr'), ('c', 'en')):
+            self.write('src/{}.kit'.format(name),
+                       '<!--$lang={}-->{}<!--@include body-->'.format(
+                           lang, name.upper()))
+        self.write('src/d.kit', 'D<!--@include body-->')
+        self.stats = Stats()
+        self.obj = Compiler(stats=self.stats, cache_expansions=True)
+
+    def test(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.assertEqual([self.read('dest/{}.html'.format(name))
+                          for name in 'abcd'],
+                         ['ABenN', 'BBfrN', 'CBenN', 'DBN'])
+        self.assertEqual(self.stats.counters['expansion_misses'], 2)
+        self.assertEqual(self.stats.counters['expansion_hits'], 1)
+        self.assertEqual(
+            self.obj.expansions,
+            {self.path('src/_body.kit'): {('en',): 'BenN', ('fr',): 'BfrN'}})
+
+    def test_changed(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.write('src/_nav.kit', 'NN')
+        self.obj.refresh()
+        self.assertEqual(self.obj.expansions, {})
+        self.assertEqual(self.obj.generate_to_str(self.path('src/a.kit')),
+                         'ABenNN')
+
+    def test_cyclic(self):
+        from ..compiler import CyclicInclusionError
+        self.write('src/_body.kit', '<!--$lang--><!--@include e-->')
+        self.write('src/e.kit', '<!--@include body-->')
+        self.assertRaises(CyclicInclusionError, self.obj.generate_to_str,
+                          self.path('src/e.kit'))
+
+
+class LinkOutputsTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler, Stats
+        super(LinkOutputsTestCase, self).setUp()
+        os.makedirs(self.path('src'))
+        self.write('src/_p.kit', 'P')
+        self.write('src/a.kit', 'X<!--@include p-->')
+        self.write('src/b.kit', 'X<!--@include p-->')
+        self.write('src/c.kit', 'C')
+        self.stats = Stats()
+        self.obj = Compiler(stats=self.stats, link_outputs=True)
+
+    def test(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.assertEqual(self.read('dest/b.html'), 'XP')
+        self.assertEqual(os.stat(self.path('dest/a.html')).st_ino,
+                         os.stat(self.path('dest/b.html')).st_ino)
+        self.assertNotEqual(os.stat(self.path('dest/a.html')).st_ino,
+                            os.stat(self.path('dest/c.html')).st_ino)
+        self.assertEqual(self.stats.counters['outputs_linked'], 1)
+        # linked outputs are replaced, not rewritten in place
+        self.write('src/b.kit', 'Y<!--@include p-->')
+        self.obj.refresh()
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.assertEqual(self.read('dest/a.html'), 'XP')
+        self.assertEqual(self.read('dest/b.html'), 'YP')
+        self.assertEqual(self.stats.counters['outputs_linked'], 1)
+
+    def test_linked_already(self):
+        from ..compiler import files_equal
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.obj.refresh()
+        with mock.patch('codekitlang.compiler.files_equal',
+                        wraps=files_equal) as mocked:
+            self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        # b.html is compared with a.html by digest and inode only
+        self.assertEqual(
+            [call[0][1] for call in mocked.call_args_list],
+            [self.path('dest/a.html'), self.path('dest/c.html')])
+        self.assertEqual(os.stat(self.path('dest/a.html')).st_ino,
+                         os.stat(self.path('dest/b.html')).st_ino)
+        self.assertEqual(self.stats.counters['outputs_linked'], 1)
+        self.assertEqual(self.stats.counters['outputs_unchanged'], 3)
+
+    def test_link_error(self):
+        with mock.patch('os.link', side_effect=OSError('EXDEV')):
+            self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        self.assertEqual(self.read('dest/b.html'), 'XP')
+        self.assertNotEqual(os.stat(self.path('dest/a.html')).st_ino,
+                            os.stat(self.path('dest/b.html')).st_ino)
+        self.assertEqual(sorted(os.listdir(self.path('dest'))),
+                         ['a.html', 'b.html', 'c.html'])
+
+    def test_rewritten(self):
+        self.obj.generate_to_dir(self.path('dest'), self.path('src'))
+        # a.html no longer has the digest it was recorded with
+        self.write('src/a.kit', 'Y')
+        self.write('src/b.kit', 'XP')
+        self.obj.invalidate([self.path('src/a.kit'), self.path('src/b.kit')])
+        self.obj.generate_to_file(self.path('dest/a.html'),
+                                  self.path('src/a.kit'))
+        self.obj.generate_to_file(self.path('dest/b.html'),
+                                  self.path('src/b.kit'))
+        self.assertEqual(self.read('dest/a.html'), 'Y')
+        self.assertEqual(self.read('dest/b.html'), 'XP')
+        self.assertEqual(self.stats.counters['outputs_linked'], 1)
+
+    def test_changed_target(self):
+        self.obj.generate_to_file(self.path('dest/a.html'),
+                                  self.path('src/a.kit'))
+        # modified behind the compiler's back
+        self.write('dest/a.html', 'changed')
+        self.obj.generate_to_file(self.path('dest/b.html'),
+                                  self.path('src/b.kit'))
+        self.assertEqual(self.read('dest/a.html'), 'changed')
+        self.assertEqual(self.read('dest/b.html'), 'XP')
+        self.assertNotIn('outputs_linked', self.stats.counters)
+        self.assertEqual(self.obj.output_digests.keys(),
+                         [self.obj.output_paths[self.path('dest/b.html')]])
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import json
+import StringIO
+import threading
+import mock
+from .base import TempTreeTestCase
+import testfixtures
+
+
+class ServerTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        from ..server import Server
+        super(ServerTestCase, self).setUp()
+        self.write('_header.kit', 'H')
+        self.write('a.kit', 'A<!--@include header-->')
+        self.obj = Server(Compiler(missing_file_behavior='exception'))
+
+    def test_handle(self):
+        request = dict(src=self.path('a.kit'), dest=self.path('a.html'))
+        self.assertEqual(self.obj.handle(request), dict(status='ok'))
+        self.assertEqual(self.read('a.html'), 'AH')
+        self.write('_header.kit', 'HH')
+        self.assertEqual(self.obj.handle(request), dict(status='ok'))
+        self.assertEqual(self.read('a.html'), 'AHH')
+
+    def test_handle_error(self):
+        response = self.obj.handle(dict(src=self.path('b.kit'),
+                                        dest=self.path('b.html')))
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('b.kit', response['message'])
+        self.assertEqual(self.obj.handle(dict(src='a')),
+                         dict(status='error', message='invalid request'))
+
+    @testfixtures.log_capture()
+    def test_handle_unexpected(self, l):
+        """
+        @type l: testfixtures.LogCapture
+        """
+        request = dict(src=self.path('a.kit'), dest=self.path('a.html'))
+        with mock.patch('codekitlang.compiler.Compiler.generate_to_file',
+                        side_effect=ValueError('V')):
+            self.assertEqual(self.obj.handle(request),
+                             dict(status='error', message='ValueError: V'))
+        l.check(
+            ('codekitlang.compiler', 'ERROR',
+             'failed to compile {}'.format(self.path('a.kit'))),
+        )
+        self.assertEqual(self.obj.handle(request), dict(status='ok'))
+
+    def test_manifest(self):
+        from ..compiler import Compiler
+        from ..server import Server
+        manifest = self.path('manifest.json')
+        obj = Server(Compiler(), manifest=manifest)
+        request = dict(src=self.path('a.kit'), dest=self.path('a.html'))
+        with mock.patch('codekitlang.compiler.Compiler.dump_manifest') \
+                as mocked:
+            self.assertEqual(obj.handle(request), dict(status='ok'))
+            # changed, but dumped in MANIFEST_INTERVAL
+            self.assertTrue(obj.manifest_changed)
+            self.assertFalse(mocked.called)
+            obj.manifest_dumped = 0
+            self.assertEqual(obj.handle(request), dict(status='ok'))
+            # up to date, entry not changed
+            self.assertFalse(mocked.called)
+            self.write('_header.kit', 'HH')
+            self.assertEqual(obj.handle(request), dict(status='ok'))
+            mocked.assert_called_once_with(manifest)
+        self.assertFalse(obj.manifest_changed)
+        self.write('_header.kit', 'HHH')
+        obj.serve_stream(StringIO.StringIO(json.dumps(request)),
+                         StringIO.StringIO())
+        with open(manifest, 'rb') as fp:
+            stored = json.load(fp)
+        self.assertIn(self.path('a.html'), stored['outputs'])
+        self.assertFalse(obj.manifest_changed)
+
+    def test_refresh_scoped(self):
+        request = dict(src=self.path('a.kit'), dest=self.path('a.html'))
+        with mock.patch('codekitlang.compiler.Compiler.refresh') as mocked:
+            self.obj.handle(request)
+            mocked.assert_called_once_with([self.path('a.kit')])
+
+    def test_serve_stream(self):
+        rfile = StringIO.StringIO('\n'.join([
+            json.dumps(dict(src=self.path('a.kit'),
+                            dest=self.path('a.html'))),
+            '',
+            'broken',
+        ]))
+        wfile = StringIO.StringIO()
+        self.obj.serve_stream(rfile, wfile)
+        self.assertEqual(
+            [json.loads(line) for line in wfile.getvalue().splitlines()],
+            [dict(status='ok'),
+             dict(status='error', message='invalid request')])
+        self.assertEqual(self.read('a.html'), 'AH')
+
+    def test_unix(self):
+        from ..server import request
+        path = self.path('socket')
+        unix_server = self.obj.make_unix_server(path)
+        thread = threading.Thread(target=unix_server.handle_request)
+        thread.start()
+        try:
+            self.assertEqual(
+                request(path, self.path('a.kit'), self.path('a.html')),
+                dict(status='ok'))
+        finally:
+            thread.join()
+            unix_server.server_close()
+        self.assertEqual(self.read('a.html'), 'AH')
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mock
+from .base import TempTreeTestCase
+
+
+class WatcherTestCase(TempTreeTestCase):
+
+    def setUp(self):
+        from ..compiler import Compiler
+        from ..watcher import Watcher
+        super(WatcherTestCase, self).setUp()
+        self.srcdir = os.path.join(self.tempdir, 'src')
+        self.destdir = os.path.join(self.tempdir, 'dest')
+        os.makedirs(self.srcdir)
+        self.write('src/_header.kit', 'H')
+        self.write('src/_footer.kit', 'F')
+        self.write('src/a.kit', 'A<!--@include header-->')
+        self.write('src/b.kit', 'B<!--@include header, footer-->')
+        self.write('src/c.kit', 'C<!--@include footer-->')
+        self.obj = Watcher(Compiler(), self.destdir, self.srcdir,
+                           polling=True)
+
+    def test_build(self):
+        self.assertEqual(len(self.obj.build()), 3)
+        self.assertEqual(self.read('dest/b.html'), 'BHF')
+        self.assertEqual(self.obj.check(), [])
+
+    def test_partial_changed(self):
+        self.obj.build()
+        self.write('src/_footer.kit', 'FF')
+        self.assertEqual(self.obj.check(),
+                         [self.path('src/b.kit'), self.path('src/c.kit')])
+        self.assertEqual(self.read('dest/b.html'), 'BHFF')
+        self.assertEqual(self.read('dest/c.html'), 'CFF')
+        self.assertEqual(self.obj.check(), [])
+
+    def test_page_added_and_removed(self):
+        self.obj.build()
+        self.write('src/d.kit', 'D')
+        os.remove(self.path('src/a.kit'))
+        self.assertEqual(self.obj.check(), [self.path('src/d.kit')])
+        self.assertEqual(self.read('dest/d.html'), 'D')
+        self.assertNotIn(self.path('src/a.kit'), self.obj.pages)
+
+    def test_error_logged(self):
+        from ..compiler import VariableNotFoundError
+        self.obj.build()
+        self.obj.compiler.missing_variable_behavior = 'exception'
+        self.write('src/_header.kit', '<!--$missing-->')
+        with mock.patch.object(self.obj.logger, 'error') as mocked_error:
+            self.assertEqual(self.obj.check(), [])
+            self.assertEqual(mocked_error.call_count, 2)
+        self.assertRaises(VariableNotFoundError, self.obj.compiler.
+                          generate_to_str, self.path('src/a.kit'))
+
+    def test_update(self):
+        self.obj.build()
+        self.write('src/_header.kit', 'HH')
+        affected = self.obj.compiler.invalidate(
+            [self.path('src/_header.kit')])
+        self.assertEqual(self.obj.update(affected),
+                         [self.path('src/a.kit'), self.path('src/b.kit')])
+        self.assertEqual(self.read('dest/a.html'), 'AHH')
+
+    def test_handle_events(self):
+        from ..compiler import Compiler
+        from ..watcher import Watcher
+        obj = Watcher(Compiler(link_outputs=True), self.path('dest'),
+                      self.path('src'), polling=True)
+        obj.build()
+        self.write('src/a.kit', 'A<!--@include header-->')
+        self.write('src/b.kit', 'B<!--@include header-->')
+        self.assertEqual(
+            obj.handle_events(set([self.path('src/a.kit'),
+                                   self.path('src/b.kit')])),
+            [self.path('src/a.kit'), self.path('src/b.kit')])
+        # outputs of the last batch are not linked to
+        self.write('src/a.kit', 'B<!--@include header-->')
+        self.write('src/b.kit', 'A<!--@include header-->')
+        with mock.patch.object(obj.compiler, 'start_build',
+                               wraps=obj.compiler.start_build) as mocked:
+            obj.handle_events(set([self.path('src/a.kit'),
+                                   self.path('src/b.kit')]))
+        mocked.assert_called_once_with()
+        self.assertEqual(self.read('dest/a.html'), 'BH')
+        self.assertEqual(self.read('dest/b.html'), 'AH')
+        self.write('src/d.kit', 'D')
+        self.assertEqual(obj.handle_events(set(), rescan=True),
+                         [self.path('src/d.kit')])
+
+    def test_single_file(self):
+        from ..compiler import Compiler
+        from ..watcher import Watcher
+        obj = Watcher(Compiler(), self.path('out.html'),
+                      self.path('src/a.kit'), polling=True)
+        obj.build()
+        self.assertEqual(self.read('out.html'), 'AH')
+        self.write('src/_header.kit', 'HH')
+        self.assertEqual(obj.check(), [self.path('src/a.kit')])
+        self.assertEqual(self.read('out.html'), 'AHH')
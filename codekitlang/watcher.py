@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import os
+import Queue
+import time
+from . import compiler
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pragma:nocover
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class _EventHandler(FileSystemEventHandler):
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        rescan = event.event_type in ('created', 'deleted', 'moved')
+        self.queue.put((event.src_path, rescan))
+        if event.event_type == 'moved':
+            self.queue.put((event.dest_path, rescan))
+
+
+class Watcher(object):
+    """
+    Regenerate pages affected by changes of their sources or included files.
+
+    Uses watchdog when it is installed, otherwise polls signatures of parsed
+    files by `Compiler.refresh`.
+    """
+
+    interval = 1.0
+
+    def __init__(self, compiler_, dest, src, interval=None, polling=None):
+        """
+        @type compiler_: codekitlang.compiler.Compiler
+        @param dest: output file or directory
+        @param src: input file or directory
+        @param interval: seconds between checks (default: 1.0)
+        @param polling: do not use watchdog (default: True unless watchdog
+                        is installed)
+        """
+        self.compiler = compiler_
+        self.logger = compiler_.logger
+        self.dest = dest
+        self.src = os.path.realpath(src)
+        if interval is not None:
+            self.interval = interval
+        if polling is None:
+            polling = Observer is None
+        self.polling = polling
+        self.pages = dict()
+
+    def list_pages(self):
+        """
+        @return: input path -> output path
+        @rtype: dict
+        """
+        if os.path.isdir(self.src):
+            pages = self.compiler.list_pages(self.dest, self.src)
+        elif os.path.exists(self.src):
+            pages = [(self.dest, self.src)]
+        else:
+            pages = []
+        return dict((src, dest) for dest, src in pages)
+
+    def generate(self, srcs):
+        """
+        @param srcs: input paths of pages to generate
+        @return: generated input paths
+        @rtype: [str, ...]
+        """
+        generated = []
+        for src in sorted(srcs):
+            dest = self.pages[src]
+            self.logger.info('Compiling %s to %s', src, dest)
+            try:
+                self.compiler.generate_to_file(dest, src)
+            except compiler.CompileError as e:
+                self.logger.error(e.to_message())
+                continue
+            generated.append(src)
+        return generated
+
+    def build(self):
+        self.pages = self.list_pages()
+        return self.generate(self.pages)
+
+    def update(self, affected, rescan=False):
+        """
+        @param affected: changed files and files including them
+        @type affected: set
+        @param rescan: look for created and removed pages
+        @return: generated input paths
+        @rtype: [str, ...]
+        """
+        srcs = affected.intersection(self.pages)
+        if rescan:
+            pages = self.list_pages()
+            srcs.update(set(pages).difference(self.pages))
+            srcs.intersection_update(pages)
+            self.pages = pages
+        return self.generate(srcs)
+
+    def check(self):
+        """
+        Stat parsed files once and regenerate affected pages.
+
+        @return: generated input paths
+        @rtype: [str, ...]
+        """
+        return self.update(self.compiler.refresh(), rescan=True)
+
+    def handle_events(self, filepaths, rescan=False):
+        """
+        Start a build for a batch of events and regenerate affected pages.
+
+        @param filepaths: `realpath`ed full paths of changed files
+        @type filepaths: set
+        @param rescan: files were created or removed
+        @return: generated input paths
+        @rtype: [str, ...]
+        """
+        self.compiler.start_build()
+        affected = self.compiler.invalidate(filepaths)
+        if rescan:
+            # created or removed files may change include paths
+            affected.update(self.compiler.refresh())
+        return self.update(affected, rescan)
+
+    def run(self):  # pragma:nocover
+        self.build()
+        if self.polling:
+            while True:
+                time.sleep(self.interval)
+                self.check()
+        queue = Queue.Queue()
+        observer = Observer()
+        paths = (os.path.dirname(self.src) if os.path.isfile(self.src)
+                 else self.src,) + self.compiler.framework_paths
+        for path in paths:
+            observer.schedule(_EventHandler(queue), path, recursive=True)
+        observer.start()
+        try:
+            while True:
+                events = [queue.get()]
+                time.sleep(self.interval)  # gather burst of events
+                while not queue.empty():
+                    events.append(queue.get())
+                self.handle_events(
+                    set(os.path.realpath(p) for p, _ in events),
+                    any(r for _, r in events))
+        finally:
+            observer.stop()
+            observer.join()
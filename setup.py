@@ -42,6 +42,7 @@ setup(
     include_package_data=False,
     zip_safe=False,
     install_requires=('setuptools',),
+    extras_require={'watch': ('watchdog',)},
     tests_require=('pytest-cov', 'pytest-pep8', 'pytest-flakes', 'mock',
                    'testfixtures', 'pytest-cache', ),
     cmdclass={'test': PyTest},